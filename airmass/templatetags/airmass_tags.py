@@ -1,21 +1,23 @@
-from plotly import offline
 import plotly.graph_objs as go
 from django import template
 
 from tom_targets.models import Target
 from tom_targets.forms import TargetVisibilityForm
-from tom_observations import utils, facility
-from tom_dataproducts.models import DataProduct, ReducedDatum, ObservationRecord
+from tom_observations import utils
+from tom_dataproducts.models import ReducedDatum, ObservationRecord
 
-from astroplan import Observer, FixedTarget, AtNightConstraint, time_grid_from_range, moon_illumination
+from astroplan import AtNightConstraint, moon_illumination
 import datetime
 import json
-from astropy.time import Time
-from astropy import units as u
-from astropy.coordinates import get_moon, get_sun, SkyCoord, AltAz
+from astropy.coordinates import get_moon, SkyCoord, AltAz
 import numpy as np
 import time
 
+from custom_code.visibility import get_time_grid, get_visibility
+from custom_code.photometry import get_photometry
+from custom_code.spectra import get_spectra
+from custom_code.plotting import render_figure
+
 register = template.Library()
 
 
@@ -25,6 +27,11 @@ def airmass_plot(context):
     interval = 15 #min
     airmass_limit = 3.0
     plot_data = get_24hr_airmass(context['object'], interval, airmass_limit)
+    if plot_data is None:
+        return {
+            'target': context['object'],
+            'figure': 'No coordinates for this target.'
+        }
     layout = go.Layout(
         yaxis=dict(range=[airmass_limit,1.0]),
         margin=dict(l=20,r=10,b=30,t=40),
@@ -32,78 +39,35 @@ def airmass_plot(context):
         width=600,
         height=300
     )
-    visibility_graph = offline.plot(
-        go.Figure(data=plot_data, layout=layout), output_type='div', show_link=False
-    )
+    visibility_graph = render_figure(go.Figure(data=plot_data, layout=layout))
     return {
         'target': context['object'],
         'figure': visibility_graph
     }
 
 def get_24hr_airmass(target, interval, airmass_limit):
+    if target.ra is None or target.dec is None:
+        return None
 
     plot_data = []
     
-    start = Time(datetime.datetime.utcnow())
-    end = Time(start.datetime + datetime.timedelta(days=1))
-    time_range = time_grid_from_range(
-        time_range = [start, end],
-        time_resolution = interval*u.minute)
+    start = datetime.datetime.utcnow()
+    end = start + datetime.timedelta(days=1)
+    time_range = get_time_grid(start, end, interval)
     time_plot = time_range.datetime
     
-    fixed_target = FixedTarget(name = target.name, 
-        coord = SkyCoord(
-            target.ra,
-            target.dec,
-            unit = 'deg'
-        )
-    )
-
-    #Hack to speed calculation up by factor of ~3
-    sun_coords = get_sun(time_range[int(len(time_range)/2)])
-    fixed_sun = FixedTarget(name = 'sun',
-        coord = SkyCoord(
-            sun_coords.ra,
-            sun_coords.dec,
-            unit = 'deg'
-        )
-    )
-
-    for observing_facility in facility.get_service_classes():
+    coords = SkyCoord(target.ra, target.dec, unit='deg')
+    sites, airmass = get_visibility(coords, time_range, airmass_limit, facilities=['LCO'])
 
-        if observing_facility != 'LCO':
-            continue
+    for (observing_facility, site), obj_airmass in zip(sites, airmass):
 
-        observing_facility_class = facility.get_service_class(observing_facility)
-        sites = observing_facility_class().get_observing_sites()
-
-        for site, site_details in sites.items():
-
-            observer = Observer(
-                longitude = site_details.get('longitude')*u.deg,
-                latitude = site_details.get('latitude')*u.deg,
-                elevation = site_details.get('elevation')*u.m
-            )
-            
-            sun_alt = observer.altaz(time_range, fixed_sun).alt
-            obj_airmass = observer.altaz(time_range, fixed_target).secz
-
-            bad_indices = np.argwhere(
-                (obj_airmass >= airmass_limit) |
-                (obj_airmass <= 1) |
-                (sun_alt > -18*u.deg)  #between astro twilights
-            )
-
-            obj_airmass = [np.nan if i in bad_indices else float(x)
-                for i, x in enumerate(obj_airmass)]
-
-            label = '({facility}) {site}'.format(
-                facility = observing_facility, site = site
-            )
+        label = '({facility}) {site}'.format(
+            facility = observing_facility, site = site
+        )
 
-            plot_data.append(
-                go.Scatter(x=time_plot, y=obj_airmass, mode='lines', name=label, )
-            )
+        plot_data.append(
+            go.Scatter(x=time_plot, y=obj_airmass.filled(np.nan), mode='lines', name=label, )
+        )
 
     return plot_data
 
@@ -128,13 +92,7 @@ def lightcurve(target):
         except: color = colors['other']
         return color
          
-    photometry_data = {}
-    for rd in ReducedDatum.objects.filter(target=target, data_type='photometry'):
-        value = rd.value
-        photometry_data.setdefault(value.get('filter', ''), {})
-        photometry_data[value.get('filter', '')].setdefault('time', []).append(rd.timestamp)
-        photometry_data[value.get('filter', '')].setdefault('magnitude', []).append(value.get('magnitude',None))
-        photometry_data[value.get('filter', '')].setdefault('error', []).append(value.get('error', None))
+    photometry_data = get_photometry(ReducedDatum.objects.filter(target=target, data_type='photometry'))
     plot_data = [
         go.Scatter(
             x=filter_values['time'],
@@ -158,7 +116,7 @@ def lightcurve(target):
     if plot_data:
       return {
           'target': target,
-          'plot': offline.plot(go.Figure(data=plot_data, layout=layout), output_type='div', show_link=False)
+          'plot': render_figure(go.Figure(data=plot_data, layout=layout))
       }
     else:
         return {
@@ -171,15 +129,9 @@ def spectra_plot(target, dataproduct=None):
     spectra = []
     spectral_dataproducts = ReducedDatum.objects.filter(target=target, data_type='spectroscopy')
     if dataproduct:
-        spectral_dataproducts = DataProduct.objects.get(dataproduct=dataproduct)
-    for spectrum in spectral_dataproducts:
-        datum = spectrum.value
-        wavelength = []
-        flux = []
+        spectral_dataproducts = spectral_dataproducts.filter(data_product=dataproduct)
+    for spectrum, wavelength, flux in get_spectra(spectral_dataproducts):
         name = str(spectrum.timestamp).split(' ')[0]
-        for key, value in datum.items():
-            wavelength.append(value['wavelength'])
-            flux.append(float(value['flux']))
         spectra.append((wavelength, flux, name))
     plot_data = [
         go.Scatter(
@@ -203,7 +155,7 @@ def spectra_plot(target, dataproduct=None):
     if plot_data:
       return {
           'target': target,
-          'plot': offline.plot(go.Figure(data=plot_data, layout=layout), output_type='div', show_link=False)
+          'plot': render_figure(go.Figure(data=plot_data, layout=layout))
       }
     else:
         return {
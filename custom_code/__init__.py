@@ -0,0 +1 @@
+default_app_config = 'custom_code.apps.CustomPlotsConfig'
@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class CustomPlotsConfig(AppConfig):
     name = 'custom_code'
+
+    def ready(self):
+        import custom_code.signals  # noqa: F401
@@ -0,0 +1,103 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Count, Max
+from tom_dataproducts.models import DataProduct, ReducedDatum
+import time
+
+PLOT_CACHE = 'plots'
+
+# Airmass plots only depend on the time of day, so they are cached
+# per time bucket instead of per data version
+AIRMASS_CACHE_BUCKET = 30*60  # seconds
+
+
+def get_plot_cache():
+    return caches[PLOT_CACHE]
+
+
+def _generation_key(target_id):
+    return f'generation_{target_id}'
+
+
+def get_data_version(target_id):
+    """
+    Returns a version stamp for the data of a target, derived from its
+    ReducedDatum and DataProduct rows plus a generation counter that is bumped
+    by ``invalidate_target_plots``.
+    """
+    datums = ReducedDatum.objects.filter(target_id=target_id).aggregate(count=Count('id'), latest=Max('id'))
+    data_products = DataProduct.objects.filter(target_id=target_id).aggregate(
+        count=Count('id'), modified=Max('modified'))
+    modified = data_products['modified'].timestamp() if data_products['modified'] else 0
+    generation = get_plot_cache().get(_generation_key(target_id), 0)
+    return '{}-{}-{}-{}-{:.0f}'.format(generation, datums['count'], datums['latest'], data_products['count'], modified)
+
+
+def invalidate_target_plots(target_id):
+    """
+    Invalidates every cached plot of a target. Should be called whenever
+    photometry or spectra are added to or removed from the target.
+    """
+    cache = get_plot_cache()
+    try:
+        cache.incr(_generation_key(target_id))
+    except ValueError:
+        cache.set(_generation_key(target_id), 1, None)
+
+
+def get_or_set_target_plot(name, target_id, render, user=None):
+    """
+    Returns the cached plot called ``name`` for a target, calling ``render``
+    to create it if the target's data changed since it was last cached.
+    Plots are cached per user when object permissions are in use.
+    """
+    key = f'{name}_{target_id}_{get_data_version(target_id)}'
+    if user is not None and not settings.TARGET_PERMISSIONS_ONLY:
+        key += f'_{user.id}'
+
+    cache = get_plot_cache()
+    plot = cache.get(key)
+    if plot is None:
+        plot = render()
+        cache.set(key, plot)
+    return plot
+
+
+def _airmass_key(name, target):
+    bucket = int(time.time() // AIRMASS_CACHE_BUCKET)
+    return f'{name}_{target.id}_{target.ra}_{target.dec}_{bucket}'
+
+
+def get_or_set_airmass_plot(name, target, render):
+    """
+    Returns the cached airmass plot called ``name`` for a target for the
+    current time bucket, calling ``render`` to create it if needed.
+    """
+    key = _airmass_key(name, target)
+    cache = get_plot_cache()
+    plot = cache.get(key)
+    if plot is None:
+        plot = render()
+        cache.set(key, plot, timeout=AIRMASS_CACHE_BUCKET)
+    return plot
+
+
+def get_or_set_airmass_plots(targets, render):
+    """
+    Returns a dictionary of cached airmass plots keyed by target id for the
+    current time bucket, calling ``render`` once with all of the targets
+    that are not cached yet.
+    """
+    keys = {target.id: _airmass_key('airmass', target) for target in targets}
+
+    cache = get_plot_cache()
+    cached = cache.get_many(keys.values())
+    plots = {target_id: cached[key] for target_id, key in keys.items() if key in cached}
+
+    missing = [target for target in targets if target.id not in plots]
+    if missing:
+        rendered = render(missing)
+        cache.set_many({keys[target_id]: plot for target_id, plot in rendered.items()}, timeout=AIRMASS_CACHE_BUCKET)
+        plots.update(rendered)
+
+    return plots
@@ -0,0 +1,135 @@
+import glob
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from astropy.coordinates import SkyCoord
+from astropy.io import fits
+from astropy.table import Table
+from django.conf import settings
+from spikepipe.spikepipe import load_catalog, PS1_CATALOG_PATH
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Catalogs of the most recently observed targets kept in memory, keyed by cache file name
+PS1_CACHE_SIZE = 16
+_ps1_cache = OrderedDict()
+_ps1_lock = threading.Lock()
+
+
+def _get_cache_filename(target_coords):
+    """
+    Returns the cache file of the catalog around ``target_coords``. The
+    modification time of the PS1 catalog is part of the name, so updating the
+    catalog invalidates the cache.
+    """
+    try:
+        version = int(os.path.getmtime(PS1_CATALOG_PATH))
+    except OSError:
+        version = 0
+    name = f'ps1_{target_coords.ra.deg:.6f}_{target_coords.dec.deg:+.6f}_{version}.fits'
+    return os.path.join(settings.PS1_CACHE_LOCATION, name)
+
+
+def _write_cached_catalog(filename, catalog, catalog_coords, target):
+    """
+    Writes the catalog, the ICRS coordinates of its sources and the target to
+    a FITS file. Targets other than a SkyCoord or a number are not cached.
+    """
+    coords = catalog_coords.icrs
+    coords_hdu = fits.BinTableHDU(Table({'ra': coords.ra.deg, 'dec': coords.dec.deg}), name='COORDS')
+    if isinstance(target, SkyCoord):
+        coords_hdu.header['TARG_RA'] = target.icrs.ra.deg
+        coords_hdu.header['TARG_DEC'] = target.icrs.dec.deg
+    elif isinstance(target, (int, float, np.number)):
+        coords_hdu.header['TARGET'] = target.item() if isinstance(target, np.number) else target
+    else:
+        logger.info(f'Not caching a PS1 catalog with a target of type {type(target).__name__}')
+        return
+    hdul = fits.HDUList([fits.PrimaryHDU(), fits.table_to_hdu(Table(catalog)), coords_hdu])
+
+    os.makedirs(settings.PS1_CACHE_LOCATION, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=settings.PS1_CACHE_LOCATION, suffix='.tmp', delete=False) as f:
+        hdul.writeto(f)
+    os.replace(f.name, filename)  # so other processes never read a partial file
+    _evict_cached_catalogs()
+
+
+def _read_cached_catalog(filename):
+    """
+    Reads a catalog written by ``_write_cached_catalog``, memory-mapped, and
+    marks it as recently used
+    """
+    catalog = Table.read(filename, hdu=1, memmap=True)
+    with fits.open(filename, memmap=True) as hdul:
+        header = hdul['COORDS'].header
+        data = hdul['COORDS'].data
+        catalog_coords = SkyCoord(np.array(data['ra']), np.array(data['dec']), unit='deg')
+        if 'TARGET' in header:
+            target = header['TARGET']
+        else:
+            target = SkyCoord(header['TARG_RA'], header['TARG_DEC'], unit='deg')
+    os.utime(filename)
+    return catalog, catalog_coords, target
+
+
+def _evict_cached_catalogs():
+    """
+    Deletes the least recently used cache files beyond ``settings.PS1_CACHE_MAX_FILES``
+    """
+    mtimes = {}
+    for filename in glob.glob(os.path.join(settings.PS1_CACHE_LOCATION, 'ps1_*.fits')):
+        try:
+            mtimes[filename] = os.path.getmtime(filename)
+        except OSError:
+            pass
+    for filename in sorted(mtimes, key=mtimes.get)[:-settings.PS1_CACHE_MAX_FILES or None]:
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+
+def _load_cached_catalog(filename, target_coords):
+    try:
+        return _read_cached_catalog(filename)
+    except (OSError, KeyError, ValueError):
+        pass
+
+    result = load_catalog(PS1_CATALOG_PATH, target_coords)
+    try:
+        _write_cached_catalog(filename, *result)
+    except (OSError, TypeError, ValueError):
+        logger.warning(f'Could not write the PS1 catalog cache {filename}', exc_info=True)
+    return result
+
+
+def get_ps1_catalog(target_coords):
+    """
+    Returns the same ``(catalog, catalog_coords, target)`` as
+    ``spikepipe.load_catalog(PS1_CATALOG_PATH, target_coords)``, from an
+    in-process LRU or the on-disk cache when the target was seen before.
+    The ``catalog_coords`` SkyCoord is kept already built in memory.
+
+    The catalog is a copy, so callers may add columns to it.
+    """
+    filename = _get_cache_filename(target_coords)
+    with _ps1_lock:
+        cached = _ps1_cache.get(filename)
+        if cached is not None:
+            _ps1_cache.move_to_end(filename)
+
+    if cached is None:
+        cached = _load_cached_catalog(filename, target_coords)
+        with _ps1_lock:
+            _ps1_cache[filename] = cached
+            _ps1_cache.move_to_end(filename)
+            while len(_ps1_cache) > PS1_CACHE_SIZE:
+                _ps1_cache.popitem(last=False)
+
+    catalog, catalog_coords, target = cached
+    return catalog.copy(), catalog_coords, target
@@ -4,8 +4,10 @@ import plotly.graph_objs as go
 from dash.dependencies import Input, Output, State
 import json
 from django_plotly_dash import DjangoDash
-from tom_dataproducts.models import ReducedDatum
-from custom_code.models import ReducedDatumExtra
+from custom_code.photometry import get_photometry_snapshot, group_photometry_by_filter, decimate_photometry
+from django.conf import settings
+from astropy.time import Time
+import numpy as np
 
 app = DjangoDash(name='Lightcurve')
 telescopes = []
@@ -187,8 +189,9 @@ def update_template_value(selected_subtraction):
          Input('reducer-group-checklist', 'value'),
          Input('target_id', 'value'),
          Input('plot-width', 'value'),
-         Input('plot-height', 'value')])
-def update_graph(selected_telescope, subtracted_value, selected_algorithm, selected_template, selected_photometry_type, reduction_type, final_reduction_value, selected_paper, selected_groups, value, width, height):
+         Input('plot-height', 'value'),
+         Input('lightcurve-plot', 'relayoutData')])
+def update_graph(selected_telescope, subtracted_value, selected_algorithm, selected_template, selected_photometry_type, reduction_type, final_reduction_value, selected_paper, selected_groups, value, width, height, relayout_data=None):
     def get_color(filter_name):
         filter_translate = {'U': 'U', 'B': 'B', 'V': 'V',
             'g': 'g', 'gp': 'g', 'r': 'r', 'rp': 'r', 'i': 'i', 'ip': 'i',
@@ -212,11 +215,6 @@ def update_graph(selected_telescope, subtracted_value, selected_algorithm, selec
         return color
     
     target_id = value
-    photometry_data = {}
-    subtracted_photometry_data = {}
-    datumextras = ReducedDatumExtra.objects.filter(target_id=target_id, key='upload_extras', data_type='photometry')
-    
-    datums = []
     
     ### Check if this is a final reduction or not
     if 'Final' in final_reduction_value:
@@ -224,13 +222,16 @@ def update_graph(selected_telescope, subtracted_value, selected_algorithm, selec
     else:
         final_reduction = False
 
+    snapshot = get_photometry_snapshot(target_id)
+    photometry = snapshot['photometry']
+
     ### Get the data for the selected telescope
     if not selected_telescope:
-        datums.append(ReducedDatum.objects.filter(target_id=target_id, data_type='photometry'))
+        selected = np.ones(len(photometry['timestamp']), dtype=bool)
     
     else:
-        for de in datumextras:
-            de_value = de.value
+        dp_ids = set()
+        for de_value in snapshot['extras']:
 
             ### Test that this dataproduct meets the chosen criteria:
             if all([de_value.get('instrument', '') in selected_telescope,
@@ -239,38 +240,39 @@ def update_graph(selected_telescope, subtracted_value, selected_algorithm, selec
                     de_value.get('reducer_group', '') in selected_groups,
                     (not selected_paper or de_value.get('used_in', '')==selected_paper)]):
                 dp_id = de_value.get('data_product_id', '')
-                datums.append(ReducedDatum.objects.filter(target_id=target_id, data_type='photometry', data_product_id=dp_id))
+                if dp_id:
+                    dp_ids.add(dp_id)
         
         ### Finally, get the data that was automatically uploaded from snex1 db
-        if 'LCO' in selected_telescope and not final_reduction:
-            datums.append(ReducedDatum.objects.filter(target_id=target_id, data_type='photometry', data_product_id__isnull=True))
-    
-    ### Plot the data
-    if not datums:
-        return 'No photometry yet'
-    for data in datums:
-        for rd in data:
-            value = rd.value
-            if not value:
-                continue
+        include_snex1 = 'LCO' in selected_telescope and not final_reduction
+        if not dp_ids and not include_snex1:
+            return 'No photometry yet'
 
-            ### Get subtracted or unsubtracted data
-            if value.get('background_subtracted', '') == True:
-                if value.get('subtraction_algorithm', '') in selected_algorithm and value.get('template_source', '') in selected_template and 'manual' in reduction_type:
-                    subtracted_photometry_data.setdefault(value.get('filter', ''), {})
-                    subtracted_photometry_data[value.get('filter', '')].setdefault('time', []).append(rd.timestamp)
-                    subtracted_photometry_data[value.get('filter', '')].setdefault('magnitude', []).append(value.get('magnitude',None))
-                    subtracted_photometry_data[value.get('filter', '')].setdefault('error', []).append(value.get('error', None))
-            elif value.get('reduction_type', '') in reduction_type:
-                photometry_data.setdefault(value.get('filter', ''), {})
-                photometry_data[value.get('filter', '')].setdefault('time', []).append(rd.timestamp)
-                photometry_data[value.get('filter', '')].setdefault('magnitude', []).append(value.get('magnitude',None))
-                photometry_data[value.get('filter', '')].setdefault('error', []).append(value.get('error', None))
+        selected = np.array([dp_id in dp_ids or (include_snex1 and dp_id is None)
+                             for dp_id in photometry['data_product_id']], dtype=bool)
+    
+    ### Only get the data in the zoomed-in range, so that it can be shown at full resolution
+    if relayout_data and 'xaxis.range[0]' in relayout_data and 'xaxis.range[1]' in relayout_data:
+        try:
+            start, end = Time([relayout_data['xaxis.range[0]'], relayout_data['xaxis.range[1]']]).to_datetime()
+        except ValueError:
+            pass
+        else:
+            times = np.array([t.replace(tzinfo=None) for t in photometry['timestamp']])
+            selected = selected & (times >= start) & (times <= end)
 
+    ### Get subtracted or unsubtracted data
+    subtracted = photometry['background_subtracted'] == True
     if subtracted_value == 'Unsubtracted':
-        selected_photometry = photometry_data
+        in_reduction_type = np.array([r in reduction_type for r in photometry['reduction_type']], dtype=bool)
+        selected_photometry = group_photometry_by_filter(photometry, selected & ~subtracted & in_reduction_type)
     elif subtracted_value == 'Subtracted':
-        selected_photometry = subtracted_photometry_data
+        in_algorithm = np.array([a in selected_algorithm for a in photometry['subtraction_algorithm']], dtype=bool)
+        in_template = np.array([t in selected_template for t in photometry['template_source']], dtype=bool)
+        selected_photometry = group_photometry_by_filter(photometry, selected & subtracted & in_algorithm & in_template & ('manual' in reduction_type))
+
+    selected_photometry = decimate_photometry(selected_photometry, settings.LIGHTCURVE_MAX_POINTS)
+
     plot_data = [
         go.Scatter(
             x=filter_values['time'],
@@ -294,7 +296,8 @@ def update_graph(selected_telescope, subtracted_value, selected_algorithm, selec
         width=width,
         height=height,
         hovermode='closest',
-        plot_bgcolor='white'
+        plot_bgcolor='white',
+        uirevision=target_id
     )
 
     graph_data['layout'] = layout
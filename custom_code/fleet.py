@@ -0,0 +1,178 @@
+import atexit
+import fcntl
+import logging
+import multiprocessing
+import multiprocessing.util  # registers its exit handler, which joins child processes, before ours
+import os
+import threading
+import time
+from concurrent.futures import TimeoutError
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Seconds between attempts to take a FLEET slot when all of them are in use
+FLEET_SLOT_POLL_INTERVAL = 5
+
+_workers = set()
+_idle_workers = []
+_workers_lock = threading.Lock()
+
+
+def classify_target(name, ra, dec, redshift, **kwargs):
+    """
+    Runs the FLEET classifier on a single target. This is called in a FLEET
+    process, so it must not touch the database; the caller saves the results.
+
+    :returns: the FLEET assessment of the target as a dictionary, and the path of the diagnostic plot
+    :rtype: tuple
+    """
+    import matplotlib
+    matplotlib.use('Agg')  # this must be set before importing FLEET
+    from FLEET.classify import predict_SLSN
+    t_assess = predict_SLSN(name, ra, dec, redshift, import_local=False, classifier='all', plot_lightcurve=True,
+                            do_observability=True, **kwargs)
+    output_filename = f'plots/{t_assess["object_name"][0]}_output.pdf'
+    return dict(t_assess[0]), output_filename
+
+
+def _worker_main(connection):
+    """
+    Imports FLEET once, then runs ``classify_target`` on every task received
+    until the connection is closed
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import FLEET.classify  # noqa: F401
+    while True:
+        try:
+            args, kwargs = connection.recv()
+        except EOFError:
+            return
+        try:
+            result = classify_target(*args, **kwargs)
+        except Exception as e:
+            connection.send((False, f'{type(e).__name__}: {e}'))
+        else:
+            connection.send((True, result))
+
+
+class _FleetWorker:
+    """
+    A long-lived process that runs FLEET. It is spawned rather than forked,
+    so it does not inherit the database connections of the parent. It is not
+    a daemon, because FLEET starts process pools of its own.
+    """
+    def __init__(self):
+        context = multiprocessing.get_context('spawn')
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_connection,), name='FLEET worker')
+        self.process.start()
+        child_connection.close()
+
+    def stop(self):
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
+        self.connection.close()
+
+
+def _get_worker():
+    with _workers_lock:
+        if _idle_workers:
+            return _idle_workers.pop()
+    worker = _FleetWorker()
+    with _workers_lock:
+        _workers.add(worker)
+    return worker
+
+
+def _release_worker(worker):
+    with _workers_lock:
+        if worker in _workers:
+            _idle_workers.append(worker)
+
+
+def _discard_worker(worker):
+    with _workers_lock:
+        _workers.discard(worker)
+    worker.stop()
+
+
+def _acquire_slot():
+    """
+    Waits for one of the ``settings.FLEET_PROCESSES`` FLEET slots of this
+    machine, which are shared by every process (web server, runworker,
+    fleet_batch) through lock files in ``settings.FLEET_LOCK_LOCATION``.
+    The slot is released when the returned file is closed, or when the
+    process holding it exits.
+    """
+    os.makedirs(settings.FLEET_LOCK_LOCATION, exist_ok=True)
+    while True:
+        for i in range(settings.FLEET_PROCESSES):
+            slot = open(os.path.join(settings.FLEET_LOCK_LOCATION, f'fleet_{i}.lock'), 'a')
+            try:
+                fcntl.flock(slot, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                slot.close()
+            else:
+                return slot
+        time.sleep(FLEET_SLOT_POLL_INTERVAL)
+
+
+def run_fleet_classification(name, ra, dec, redshift, timeout=None, **kwargs):
+    """
+    Runs ``classify_target`` in one of the FLEET worker processes and waits
+    for the result. The workers import FLEET once and are reused, except one
+    that times out, which is stopped and replaced without affecting the runs
+    of the others. At most ``settings.FLEET_PROCESSES`` runs are in progress
+    at once on this machine; the others wait for a free slot first.
+
+    :param timeout: seconds FLEET may run, not including the time spent
+        waiting for a free slot. Defaults to ``settings.FLEET_TIMEOUT``.
+    :type timeout: float
+
+    :raises concurrent.futures.TimeoutError: if FLEET did not finish in time
+    :raises RuntimeError: if FLEET failed
+    """
+    if timeout is None:
+        timeout = settings.FLEET_TIMEOUT
+    slot = _acquire_slot()
+    try:
+        worker = _get_worker()
+        try:
+            worker.connection.send(((name, ra, dec, redshift), kwargs))
+            finished = worker.connection.poll(timeout)
+            if finished:
+                succeeded, result = worker.connection.recv()
+        except (EOFError, OSError):
+            _discard_worker(worker)
+            raise RuntimeError(f'FLEET process exited with code {worker.process.exitcode} on {name}')
+        if not finished:
+            logger.warning(f'FLEET timed out after {timeout} s on {name}, stopping its process')
+            _discard_worker(worker)
+            raise TimeoutError(f'FLEET did not finish on {name} after {timeout} s')
+        _release_worker(worker)
+        if not succeeded:
+            raise RuntimeError(f'FLEET failed on {name}: {result}')
+        return result
+    finally:
+        slot.close()
+
+
+@atexit.register
+def terminate_fleet_processes():
+    """
+    Stops the FLEET worker processes. Runs in progress then raise RuntimeError.
+    """
+    with _workers_lock:
+        workers = list(_workers)
+        _workers.clear()
+        _idle_workers.clear()
+    for worker in workers:
+        if worker.process.is_alive():
+            worker.process.terminate()
+    for worker in workers:
+        worker.process.join()
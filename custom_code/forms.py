@@ -1,15 +1,21 @@
+import logging
+
 from tom_targets.forms import SiderealTargetCreateForm, TargetForm
 from tom_targets.models import TargetExtra
 from tom_dataproducts.forms import DataProductUploadForm
 from tom_dataproducts.models import DataProduct
 from guardian.shortcuts import assign_perm, get_groups_with_perms, remove_perm
 from django import forms
-from custom_code.models import ScienceTags, TargetTags, Papers, ReducedDatumExtra
+from custom_code.models import ScienceTags, TargetTags, Papers, DataProductExtra
 from django.conf import settings
+from django.db import DatabaseError
 from django.db.models.functions import Lower
 from django.core.exceptions import ValidationError
 from django.contrib.auth.models import Group
 
+logger = logging.getLogger(__name__)
+
+
 class CustomTargetCreateForm(SiderealTargetCreateForm):
 
     sciencetags = forms.ModelMultipleChoiceField(ScienceTags.objects.all().order_by(Lower('tag')), widget=forms.CheckboxSelectMultiple, label='Science Tags')
@@ -46,9 +52,13 @@ class CustomTargetCreateForm(SiderealTargetCreateForm):
 
 
 def choices_from_reduced_datum_extras(key):
-    """Return choices for a dropdown menu based on a certain keyword in the ReducedDatumExtra table"""
-    values = {rde.value[key] for rde in ReducedDatumExtra.objects.all() if key in rde.value}
-    return [(r, r) for r in sorted(values)]
+    """Return choices for a dropdown menu based on a certain column of the DataProductExtra table"""
+    try:
+        values = DataProductExtra.objects.exclude(**{key: ''}).order_by(key).values_list(key, flat=True).distinct()
+        return [(r, r) for r in values]
+    except DatabaseError:  # e.g. before the table has been migrated
+        logger.warning(f'Could not load the {key} choices', exc_info=True)
+        return []
 
 
 class SelectOrOtherWidget(forms.widgets.MultiWidget):
@@ -4,18 +4,23 @@ from astropy.coordinates import SkyCoord
 from astropy.io import fits
 from tom_dataproducts.models import DataProduct, ReducedDatum
 from custom_code.processors.data_processor import run_custom_data_processor
-from custom_code.models import ReducedDatumExtra
+from custom_code.models import ReducedDatumExtra, DataProductExtra
+from custom_code.cache import invalidate_target_plots
+from custom_code.photometry import bulk_create_photometry
+from custom_code.jobs import enqueue_job, enqueue_spikepipe_batch
+from custom_code.fleet import run_fleet_classification
+from custom_code.catalogs import get_ps1_catalog
+from custom_code.spikepipe_pool import get_spikepipe_executor, measure_frame
 import os
 import shutil
 from django.core.files import File
+from django.db import transaction
 import matplotlib
 matplotlib.use('Agg')  # this must be set before importing FLEET
-from FLEET.classify import predict_SLSN
 from FLEET.transient import get_transient_info, generate_lightcurve, ignore_data
-from spikepipe.spikepipe import load_catalog, PS1_CATALOG_PATH, preprocess_lco_image, extract_photometry
 import numpy as np
-import threading
 import tarfile
+import io
 
 from sqlalchemy import create_engine, pool
 from sqlalchemy.orm import sessionmaker
@@ -30,38 +35,48 @@ def run_fleet(target, import_ZTF=True, import_OSC=True, import_lightcurve=True,
     if target.dec <= -32.:
         logger.info(f'{target} is too far south for FLEET')
         return
-    t_assess = predict_SLSN(target.name, target.ra, target.dec, target.extra_fields.get('redshift', np.nan),
-                            import_ZTF=import_ZTF, import_OSC=import_OSC, import_local=False,
-                            import_lightcurve=import_lightcurve, reimport_catalog=reimport_catalog,
-                            classifier='all', plot_lightcurve=True, do_observability=True)
-    output_filename = f'plots/{t_assess["object_name"][0]}_output.pdf'
-    if os.path.exists(output_filename):
-        logger.info(f'FLEET pipeline finished for {target}.')
-        dp, created = DataProduct.objects.get_or_create(
-            target=target,
-            data_product_type='image_file',
-            product_id=f'{target.name}_FLEET'
-        )
-        if created:
-            dp.data = File(open(output_filename, 'rb'), name=os.path.basename(output_filename))
-            logger.info(f'{output_filename} saved')
-        else:
-            shutil.copy2(output_filename, dp.data.path)
-            logger.info(f'{output_filename} replaced')
-        os.remove(output_filename)
-        dp.save()
-        target.save(extras=dict(t_assess[0]))
+    extras, output_filename = run_fleet_classification(
+        target.name, target.ra, target.dec, target.extra_fields.get('redshift', np.nan),
+        import_ZTF=import_ZTF, import_OSC=import_OSC, import_lightcurve=import_lightcurve,
+        reimport_catalog=reimport_catalog
+    )
+    if save_fleet_plot(target, output_filename):
+        target.save(extras=extras)
         logger.info(f'FLEET pipeline finished on {target}')
     else:
         logger.warning(f'FLEET pipeline failed on {target}')
 
 
+def save_fleet_plot(target, output_filename):
+    """
+    Saves the FLEET diagnostic plot of a target as a DataProduct, replacing the previous one.
+    Returns False if FLEET did not produce the plot, which means that it failed.
+    """
+    if not os.path.exists(output_filename):
+        return False
+    dp, created = DataProduct.objects.get_or_create(
+        target=target,
+        data_product_type='image_file',
+        product_id=f'{target.name}_FLEET'
+    )
+    if created:
+        dp.data = File(open(output_filename, 'rb'), name=os.path.basename(output_filename))
+        logger.info(f'{output_filename} saved')
+    else:
+        shutil.copy2(output_filename, dp.data.path)
+        logger.info(f'{output_filename} replaced')
+    os.remove(output_filename)
+    dp.save()
+    return True
+
+
 def fleet_lightcurve(target):
     _, _, _, object_name, ztf_data, ztf_name, tns_name, snclass, osc_data = get_transient_info(target.name, target.ra,
                                                                                                target.dec)
     output_table = generate_lightcurve(ztf_data, osc_data, object_name, ztf_name, tns_name)
     lc = ignore_data(object_name, output_table)
 
+    reduced_data = []
     for datum in lc:
         time = Time(datum['MJD'], format='mjd')
         value = {
@@ -72,14 +87,16 @@ def fleet_lightcurve(target):
         }
         if np.isfinite(datum['MagErr']):  # do not let NaN in the database
             value['error'] = datum['MagErr']
-        rd, created = ReducedDatum.objects.get_or_create(
+        reduced_data.append(ReducedDatum(
             target=target,
             data_type='photometry',
             timestamp=time.datetime,
             value=value,
             source_name=datum['Source']
-        )
-        rd.save()
+        ))
+    created = bulk_create_photometry(target, reduced_data)
+    logger.info(f'Imported {len(created)} new photometry points for {target}')
+    invalidate_target_plots(target.id)
 
 
 @contextmanager
@@ -120,71 +137,127 @@ def target_post_save(target, created):
 
     if created:
         fleet_lightcurve(target)
-        fleet_thread = threading.Thread(target=run_fleet, args=[target, False, False, False, False])
-        fleet_thread.start()
+        enqueue_job('fleet', target, import_ZTF=False, import_OSC=False, import_lightcurve=False,
+                    reimport_catalog=False)
 
 
 def multiple_data_products_post_save(dps):
     logger.info(f'Running post save hook for multiple DataProducts: {dps}')
 
+    frames = {}
     for dp in dps:
         if dp.data.path.endswith('-e91.fits.fz'):
-            logger.info(f'Starting spikepipe on {dp}')
-            spikey_thread = threading.Thread(target=run_spikepipe, args=[dp])
-            spikey_thread.start()
+            frames.setdefault(dp.target_id, []).append(dp)
         elif dp.data.path.endswith('.tar.gz'):
             logger.info(f'Saving extracted spectrum from {dp}')
-            with tarfile.open(dp.data.path) as f:
-                for member in f.getmembers():
-                    if member.name.endswith('_2df_ex.fits'):
-                        extracted_spectrum = DataProduct(
-                            target=dp.target,
-                            observation_record=dp.observation_record,
-                            data_product_type='spectroscopy',
-                            data=File(f.extractfile(member), name=member.name)
-                        )
-                        extracted_spectrum.save()
-                        fits.setval(extracted_spectrum.data.path, 'ORIGIN', value='LCOGT')  # for SpectroscopyProcessor
-                        run_custom_data_processor(extracted_spectrum, {})
+            save_extracted_spectra(dp)
         else:
             logger.info(f'{dp} has no post save hook')
 
+    for target_frames in frames.values():
+        logger.info(f'Queueing spikepipe on {target_frames}')
+        enqueue_spikepipe_batch(target_frames[0].target, [dp.id for dp in target_frames])
 
-def run_spikepipe(data_product):
-    target_coords = SkyCoord(data_product.target.ra, data_product.target.dec, unit='deg')
-    catalog, catalog_coords, target = load_catalog(PS1_CATALOG_PATH, target_coords)
-    ccddata = preprocess_lco_image(data_product.data.path, catalog_coords)
-    catalog['catalog_mag'] = catalog[ccddata.meta['FILTER'][0] + 'MeanPSFMag']
-    datum = extract_photometry(ccddata, catalog, catalog_coords, target)
-
-    time = Time(datum['MJD'], format='mjd')
-    value = {
-        'magnitude': datum['mag'],
-        'error': datum['dmag'],
-        'telescope': 'Las Cumbres',
-        'filter': datum['filter'][0],
-    }
-    rd, created = ReducedDatum.objects.get_or_create(
-        target=data_product.target,
-        data_product=data_product,
-        data_type='photometry',
-        timestamp=time.datetime,
-        value=value,
-        source_name='spikepipe'
-    )
-    rd.save()
-
-    rdextra_value = {
-        'data_product_id': data_product.id,
-        'photometry_type': 'Aperture',
-        'zp': datum['zp'],
-        'dzp': datum['dzp'],
-        'instrument': datum['telescope'],
-    }
-    reduced_datum_extra = ReducedDatumExtra(
-        target=data_product.target,
-        data_type='photometry',
-        key='upload_extras',
-        value=rdextra_value
-    )
-    reduced_datum_extra.save()
+
+def save_extracted_spectra(data_product):
+    """
+    Saves the extracted FLOYDS spectra in a .tar.gz archive as new DataProducts.
+    The archive is read as a stream in a single pass, and the header of each
+    spectrum is fixed in memory before it is written once and processed.
+    """
+    with tarfile.open(data_product.data.path, mode='r|gz') as f:
+        for member in f:
+            if not member.name.endswith('_2df_ex.fits'):
+                continue
+            hdul = fits.open(io.BytesIO(f.extractfile(member).read()))
+            hdul[0].header['ORIGIN'] = 'LCOGT'  # for SpectroscopyProcessor
+            buffer = io.BytesIO()
+            hdul.writeto(buffer)
+            extracted_spectrum = DataProduct(
+                target=data_product.target,
+                observation_record=data_product.observation_record,
+                data_product_type='spectroscopy',
+                data=File(buffer, name=member.name)
+            )
+            extracted_spectrum.save()
+            run_custom_data_processor(extracted_spectrum, {}, fits_file=io.BytesIO(buffer.getvalue()))
+
+
+def run_spikepipe_batch(target, data_product_ids):
+    """
+    Measures the photometry of a target in several e91 frames in the spikepipe
+    process pool, and saves the results with one bulk insert per table.
+    Frames that already have photometry from spikepipe are skipped. If any
+    frame fails, the others are saved before raising, so that the job is
+    retried on the failed frames only.
+    """
+    data_products = list(DataProduct.objects.filter(target=target, id__in=data_product_ids,
+                                                     dataproductextra__isnull=True))
+    if not data_products:
+        return
+    target_coords = SkyCoord(target.ra, target.dec, unit='deg')
+    get_ps1_catalog(target_coords)  # match the catalog once, the processes then load it from the cache
+
+    executor = get_spikepipe_executor()
+    futures = [executor.submit(measure_frame, dp.data.path, target_coords) for dp in data_products]
+
+    reduced_data = []
+    reduced_datum_extras = []
+    failed = []
+    for data_product, future in zip(data_products, futures):
+        try:
+            datum = future.result()
+        except Exception:
+            logger.exception(f'spikepipe failed on {data_product}')
+            failed.append(data_product.id)
+            continue
+        time = Time(datum['MJD'], format='mjd')
+        value = {
+            'magnitude': datum['mag'],
+            'error': datum['dmag'],
+            'telescope': 'Las Cumbres',
+            'filter': datum['filter'][0],
+        }
+        reduced_data.append(ReducedDatum(
+            target=target,
+            data_product=data_product,
+            data_type='photometry',
+            timestamp=time.datetime,
+            value=value,
+            source_name='spikepipe'
+        ))
+
+        rdextra_value = {
+            'data_product_id': data_product.id,
+            'photometry_type': 'Aperture',
+            'zp': datum['zp'],
+            'dzp': datum['dzp'],
+            'instrument': datum['telescope'],
+        }
+        reduced_datum_extra = ReducedDatumExtra(
+            target=target,
+            data_type='photometry',
+            key='upload_extras',
+            value=rdextra_value
+        )
+        reduced_datum_extra.set_typed_values()
+        reduced_datum_extras.append(reduced_datum_extra)
+
+    with transaction.atomic():
+        bulk_create_photometry(target, reduced_data)
+        ReducedDatumExtra.objects.bulk_create(reduced_datum_extras)
+        # bulk_create does not call ReducedDatumExtra.save, so create the DataProductExtras here
+        saved_extras = ReducedDatumExtra.objects.filter(
+            target=target, key='upload_extras',
+            value__data_product_id__in=[dp.id for dp in data_products]
+        ).order_by('id')
+        fields = {}
+        for extra in saved_extras:  # the latest extra of each data product wins, as with save
+            extra_fields = DataProductExtra.get_fields(extra)
+            fields[extra_fields['data_product_id']] = extra_fields
+        DataProductExtra.objects.bulk_create([DataProductExtra(**f) for f in fields.values()])
+    invalidate_target_plots(target.id)
+    logger.info(f'spikepipe measured {len(reduced_data)} of {len(data_products)} frames of {target}')
+    if failed:
+        # the frames measured above are skipped when the job is retried
+        raise RuntimeError(f'spikepipe failed on data products {failed} of {target}')
@@ -0,0 +1,173 @@
+import logging
+import traceback
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from custom_code.models import BackgroundJob, JOB_ACTIVE_STATUSES
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Tasks that can be queued. Each one is called with the DataProduct of the job
+# if it has one, otherwise with its Target, plus the keyword arguments of the job
+JOB_TASKS = {
+    'fleet': 'custom_code.hooks.run_fleet',
+    'spikepipe_batch': 'custom_code.hooks.run_spikepipe_batch',
+}
+
+# Failed jobs are retried after this delay times the number of attempts so far
+JOB_RETRY_DELAY = timedelta(minutes=1)
+
+# Workers update the heartbeat of their running jobs this often, and running jobs
+# without a heartbeat for JOB_STALE_TIMEOUT belong to a worker that died
+JOB_HEARTBEAT_INTERVAL = timedelta(seconds=30)
+JOB_STALE_TIMEOUT = timedelta(minutes=5)
+
+
+def get_dedupe_key(task, target, data_product=None):
+    if data_product is not None:
+        return f'{task}_dataproduct_{data_product.id}'
+    return f'{task}_target_{target.id}'
+
+
+def enqueue_job(task, target, data_product=None, dedupe_key=None, **kwargs):
+    """
+    Queues ``task`` for a target, or for one of its data products, to be run
+    by ``manage.py runworker``. If the same job is already queued or running
+    it is returned instead of queueing a new one. Jobs are the same if they
+    have the same task and target or data product, unless ``dedupe_key`` is given.
+    """
+    if task not in JOB_TASKS:
+        raise ValueError(f'Unknown job task: {task}')
+    if dedupe_key is None:
+        dedupe_key = get_dedupe_key(task, target, data_product)
+
+    try:
+        with transaction.atomic():
+            job = BackgroundJob.objects.create(
+                task=task,
+                target=target,
+                data_product=data_product,
+                kwargs=kwargs,
+                dedupe_key=dedupe_key
+            )
+    except IntegrityError:
+        job = BackgroundJob.objects.filter(dedupe_key=dedupe_key, status__in=JOB_ACTIVE_STATUSES).first()
+        logger.info(f'{task} is already queued for {data_product or target}')
+        return job
+
+    logger.info(f'Queued {task} for {data_product or target}')
+    return job
+
+
+def enqueue_spikepipe_batch(target, data_product_ids):
+    """
+    Queues spikepipe on e91 frames of a target. There is at most one queued
+    batch per target: new frames are added to it, so a frame uploaded twice
+    is only measured once. If a batch is already running, the frames go in
+    a single follow-up batch.
+    """
+    while True:
+        with transaction.atomic():
+            job = BackgroundJob.objects.select_for_update().filter(
+                task='spikepipe_batch', target=target, status='queued'
+            ).order_by('id').first()
+            if job is not None:
+                ids = set(job.kwargs.get('data_product_ids', [])) | set(data_product_ids)
+                job.kwargs['data_product_ids'] = sorted(ids)
+                job.save(update_fields=['kwargs'])
+                logger.info(f'Added {len(data_product_ids)} frames to queued spikepipe on {target}')
+                return job
+
+        dedupe_key = get_dedupe_key('spikepipe_batch', target)
+        running = BackgroundJob.objects.filter(dedupe_key=dedupe_key, status='running').first()
+        if running is not None:
+            dedupe_key += f'_after_{running.id}'
+        try:
+            with transaction.atomic():
+                job = BackgroundJob.objects.create(
+                    task='spikepipe_batch',
+                    target=target,
+                    kwargs={'data_product_ids': sorted(set(data_product_ids))},
+                    dedupe_key=dedupe_key
+                )
+        except IntegrityError:
+            continue  # another batch was queued at the same time, add the frames to it
+        logger.info(f'Queued spikepipe_batch for {target}')
+        return job
+
+
+def claim_job(worker):
+    """
+    Marks the oldest job that is ready to run as running by ``worker`` and
+    returns it, or returns None if the queue is empty. Rows locked by other
+    workers are skipped, so any number of workers can share the queue.
+    """
+    with transaction.atomic():
+        job = BackgroundJob.objects.select_for_update(skip_locked=True).filter(
+            status='queued', run_after__lte=timezone.now()
+        ).order_by('run_after', 'id').first()
+        if job is None:
+            return None
+
+        job.status = 'running'
+        job.worker = worker
+        job.started = job.heartbeat = timezone.now()
+        job.attempts += 1
+        job.save(update_fields=['status', 'worker', 'started', 'heartbeat', 'attempts'])
+    return job
+
+
+def run_job(job):
+    """
+    Runs a claimed job and records whether it finished. Failed jobs are queued
+    again with an increasing delay until they reach ``max_attempts``.
+    """
+    try:
+        task = import_string(JOB_TASKS[job.task])
+        task(job.data_product if job.data_product_id else job.target, **job.kwargs)
+    except Exception:
+        logger.exception(f'{job} failed on attempt {job.attempts}')
+        job.error = traceback.format_exc()
+        if job.attempts < job.max_attempts:
+            job.status = 'queued'
+            job.run_after = timezone.now() + JOB_RETRY_DELAY * job.attempts
+        else:
+            job.status = 'failed'
+            job.finished = timezone.now()
+    else:
+        job.status = 'finished'
+        job.error = ''
+        job.finished = timezone.now()
+    job.save(update_fields=['status', 'error', 'run_after', 'finished'])
+    return job
+
+
+def send_heartbeat(worker):
+    """
+    Marks the jobs running in ``worker`` as still alive.
+    """
+    return BackgroundJob.objects.filter(status='running', worker=worker).update(heartbeat=timezone.now())
+
+
+def requeue_stale_jobs(worker=None):
+    """
+    Queues again the jobs left running by a worker that died, or marks them
+    failed if they have no attempts left. A worker has died if it has not sent
+    a heartbeat for ``JOB_STALE_TIMEOUT``. Jobs of ``worker`` are requeued
+    straight away, because a worker starting with the same name (host and
+    process id) as a running job means that the old process is gone.
+    """
+    dead = Q(heartbeat__lt=timezone.now() - JOB_STALE_TIMEOUT) | Q(heartbeat__isnull=True)
+    if worker:
+        dead |= Q(worker=worker)
+    stale = BackgroundJob.objects.filter(dead, status='running')
+    failed = stale.filter(attempts__gte=F('max_attempts')).update(
+        status='failed', error='Worker stopped before the job finished', finished=timezone.now()
+    )
+    requeued = stale.update(status='queued', worker='')
+    return requeued, failed
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from custom_code.models import DataProductExtra, ReducedDatumExtra
+
+
+class Command(BaseCommand):
+    """
+    This management command creates or updates the DataProductExtra row of every 'upload_extras' ReducedDatumExtra.
+    Migration 0011 does this once for the existing data, and new uploads are kept in sync automatically, so it is
+    only needed to repair the table, e.g. after ReducedDatumExtras were changed with QuerySet.update.
+
+    Example: ./manage.py backfill_dataproduct_extras
+    """
+
+    help = 'Creates or updates the DataProductExtra row of every upload_extras ReducedDatumExtra'
+
+    def handle(self, *args, **options):
+        synced = 0
+        skipped = 0
+        reduced_datum_extras = ReducedDatumExtra.objects.filter(key='upload_extras').order_by('id')
+        for reduced_datum_extra in reduced_datum_extras.iterator(chunk_size=1000):
+            if DataProductExtra.sync(reduced_datum_extra) is None:
+                skipped += 1
+            else:
+                synced += 1
+
+        self.stdout.write(f'Synced {synced} DataProductExtras, skipped {skipped} without a DataProduct')
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from tom_dataproducts.models import ReducedDatum
+
+from custom_code.spectra import save_spectrum_previews
+
+
+class Command(BaseCommand):
+    """
+    This management command should be run once after migrating to save the SpectrumPreview of every existing
+    spectrum. Previews of new spectra are saved when they are processed, and spectra without a preview are still
+    shown, only more slowly.
+
+    Example: ./manage.py build_spectrum_previews
+    """
+
+    help = 'Saves the downsampled previews of the spectra that do not have one'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target-id', type=int, help='Only build the previews of this target')
+        parser.add_argument('--batch-size', type=int, default=100, help='Number of spectra loaded at once')
+
+    def handle(self, *args, **options):
+        spectra = ReducedDatum.objects.filter(data_type='spectroscopy', spectrumpreview__isnull=True)
+        if options['target_id']:
+            spectra = spectra.filter(target_id=options['target_id'])
+        ids = list(spectra.order_by('id').values_list('id', flat=True))
+
+        saved = 0
+        for start in range(0, len(ids), options['batch_size']):
+            batch = ReducedDatum.objects.filter(id__in=ids[start:start + options['batch_size']])
+            saved += save_spectrum_previews(batch)
+        self.stdout.write(f'Saved {saved} spectrum previews')
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from tom_dataproducts.models import ReducedDatum
+
+from custom_code.spectra import convert_to_binary
+
+
+class Command(BaseCommand):
+    """
+    This management command saves a compact BinarySpectrum copy of the wavelength and flux of existing spectra,
+    which the SNEx2 plots read instead of the JSON value of their ReducedDatum. The JSON value is left as it is.
+    Set SPECTRUM_STORAGE = 'binary' so that new spectra are stored the same way.
+
+    Example: ./manage.py convert_spectra
+    """
+
+    help = 'Saves float32 BinarySpectrum copies of the spectra stored as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target-id', type=int, help='Only convert the spectra of this target')
+
+    def handle(self, *args, **options):
+        spectra = ReducedDatum.objects.filter(data_type='spectroscopy', binaryspectrum__isnull=True).order_by('id')
+        if options['target_id']:
+            spectra = spectra.filter(target_id=options['target_id'])
+
+        converted = 0
+        failed = 0
+        for reduced_datum in spectra.iterator(chunk_size=100):
+            try:
+                convert_to_binary(reduced_datum)
+                converted += 1
+            except (KeyError, TypeError, ValueError, AttributeError) as e:
+                self.stderr.write(f'Could not convert ReducedDatum {reduced_datum.id}: {e}')
+                failed += 1
+
+        self.stdout.write(f'Converted {converted} spectra, {failed} could not be converted')
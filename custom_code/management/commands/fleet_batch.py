@@ -0,0 +1,171 @@
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed
+from datetime import datetime, timedelta
+
+import numpy as np
+from dateutil.parser import parse
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from tom_targets.models import Target, TargetExtra
+
+from custom_code.fleet import run_fleet_classification
+from custom_code.hooks import save_fleet_plot
+
+
+def set_typed_values(target_extra):
+    """
+    Fills in the typed values of a TargetExtra from its value, the same way as
+    ``TargetExtra.save``, which ``bulk_create`` and ``bulk_update`` do not call
+    """
+    try:
+        target_extra.float_value = float(target_extra.value)
+    except (TypeError, ValueError, OverflowError):
+        target_extra.float_value = None
+    try:
+        target_extra.bool_value = bool(target_extra.value)
+    except (TypeError, ValueError, OverflowError):
+        target_extra.bool_value = None
+    try:
+        if isinstance(target_extra.value, datetime):
+            target_extra.time_value = target_extra.value
+        else:
+            target_extra.time_value = parse(target_extra.value)
+    except (TypeError, ValueError, OverflowError):
+        target_extra.time_value = None
+
+
+def save_target_extras(extras_by_target_id):
+    """
+    Creates or updates the TargetExtras of many targets with one query to
+    fetch the existing ones, and one bulk update and one bulk insert
+
+    :param extras_by_target_id: {target id: {key: value}}
+    :type extras_by_target_id: dict
+
+    :returns: the number of TargetExtras updated and created
+    :rtype: tuple
+    """
+    keys = {key for extras in extras_by_target_id.values() for key in extras}
+    existing = {
+        (target_extra.target_id, target_extra.key): target_extra
+        for target_extra in TargetExtra.objects.filter(target_id__in=extras_by_target_id, key__in=keys)
+    }
+
+    to_update = []
+    to_create = []
+    for target_id, extras in extras_by_target_id.items():
+        for key, value in extras.items():
+            target_extra = existing.get((target_id, key))
+            if target_extra is None:
+                target_extra = TargetExtra(target_id=target_id, key=key)
+                to_create.append(target_extra)
+            else:
+                to_update.append(target_extra)
+            target_extra.value = value
+            set_typed_values(target_extra)
+
+    with transaction.atomic():
+        TargetExtra.objects.bulk_update(to_update, ['value', 'float_value', 'bool_value', 'time_value'],
+                                        batch_size=500)
+        TargetExtra.objects.bulk_create(to_create, batch_size=500)
+    return len(to_update), len(to_create)
+
+
+class Command(BaseCommand):
+    """
+    This management command re-runs FLEET on many targets at once, for example every night on the active targets.
+    The targets are classified in parallel in the FLEET worker processes, ``FLEET_PROCESSES`` at a time, and each
+    run is stopped after ``FLEET_TIMEOUT``; the targets that have not started after ``--timeout`` seconds are
+    skipped. Nothing is shared between the runs in memory: FLEET itself reuses the ZTF and OSC photometry and the
+    catalog queries that earlier runs saved on disk, unless asked to import them again.
+
+    Example: ./manage.py fleet_batch --active-days 30 --tag 'SLSN'
+    """
+
+    help = 'Runs FLEET on all of the targets matching the given filters, reusing the files FLEET saved on disk'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tag', action='append', default=[], help='Science tag of the targets (repeatable)')
+        parser.add_argument('--classification', action='append', default=[],
+                            help='Classification of the targets (repeatable)')
+        parser.add_argument('--created-after', type=parse, help='Only targets created after this date')
+        parser.add_argument('--created-before', type=parse, help='Only targets created before this date')
+        parser.add_argument('--active-days', type=float,
+                            help='Only targets with new photometry in this many days')
+        parser.add_argument('--import-ztf', action='store_true',
+                            help='Download the ZTF photometry again instead of reusing the file FLEET saved')
+        parser.add_argument('--import-osc', action='store_true',
+                            help='Download the OSC photometry again instead of reusing the file FLEET saved')
+        parser.add_argument('--reimport-catalog', action='store_true',
+                            help='Query the catalogs again instead of reusing the files FLEET saved')
+        parser.add_argument('--timeout', type=float, default=12*3600,
+                            help='Seconds after which the targets that FLEET has not started on are skipped')
+
+    def get_targets(self, options):
+        targets = Target.objects.filter(dec__gt=-32.)  # FLEET does not cover the far south, see run_fleet
+        if options['tag']:
+            targets = targets.filter(targettags__tag__tag__in=options['tag'])
+        if options['classification']:
+            targets = targets.filter(targetextra__key='classification',
+                                     targetextra__value__in=options['classification'])
+        if options['created_after']:
+            targets = targets.filter(created__gte=options['created_after'])
+        if options['created_before']:
+            targets = targets.filter(created__lte=options['created_before'])
+        if options['active_days']:
+            since = timezone.now() - timedelta(days=options['active_days'])
+            targets = targets.filter(reduceddatum__data_type='photometry', reduceddatum__timestamp__gte=since)
+        return list(targets.distinct().order_by('id'))
+
+    def collect(self, target, future, extras_by_target_id, failed):
+        try:
+            extras, output_filename = future.result()
+        except Exception as e:
+            self.stderr.write(f'FLEET failed on {target}: {e}')
+            failed.append(target)
+            return
+        if save_fleet_plot(target, output_filename):
+            extras_by_target_id[target.id] = extras
+        else:
+            failed.append(target)
+
+    def handle(self, *args, **options):
+        targets = self.get_targets(options)
+        if not targets:
+            self.stdout.write('No targets match those filters')
+            return
+        redshifts = dict(TargetExtra.objects.filter(target__in=targets, key='redshift').values_list(
+            'target_id', 'float_value'))
+
+        self.stdout.write(f'Running FLEET on {len(targets)} targets')
+        extras_by_target_id = {}
+        failed = []
+        with ThreadPoolExecutor(max_workers=settings.FLEET_PROCESSES) as executor:
+            futures = {}
+            for target in targets:
+                redshift = redshifts.get(target.id)
+                future = executor.submit(
+                    run_fleet_classification, target.name, target.ra, target.dec,
+                    np.nan if redshift is None else redshift, import_ZTF=options['import_ztf'],
+                    import_OSC=options['import_osc'], import_lightcurve=True,
+                    reimport_catalog=options['reimport_catalog']
+                )
+                futures[future] = target
+
+            pending = set(futures)
+            try:
+                for future in as_completed(futures, timeout=options['timeout']):
+                    pending.discard(future)
+                    self.collect(futures[future], future, extras_by_target_id, failed)
+            except TimeoutError:
+                skipped = [futures[future] for future in pending if future.cancel()]
+                self.stderr.write(f'Skipping {len(skipped)} targets after {options["timeout"]} s')
+                failed.extend(skipped)
+                # The runs in progress are stopped after FLEET_TIMEOUT at the latest
+                for future in as_completed(future for future in pending if not future.cancelled()):
+                    self.collect(futures[future], future, extras_by_target_id, failed)
+
+        updated, created = save_target_extras(extras_by_target_id)
+        self.stdout.write(f'FLEET finished on {len(extras_by_target_id)} targets and failed on {len(failed)}. '
+                          f'Updated {updated} and created {created} TargetExtras')
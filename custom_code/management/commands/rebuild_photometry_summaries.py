@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from tom_targets.models import Target
+from custom_code.photometry import rebuild_photometry_summary
+
+
+class Command(BaseCommand):
+    """
+    This management command should be run once after migrating to create the PhotometrySummary row of every existing
+    target. New photometry is added to the summaries automatically.
+
+    Example: ./manage.py rebuild_photometry_summaries
+    """
+
+    help = 'Recomputes the PhotometrySummary of every target from its photometry'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target-id', type=int, help='Only rebuild the summary of this target')
+
+    def handle(self, *args, **options):
+        targets = Target.objects.order_by('id')
+        if options['target_id']:
+            targets = targets.filter(id=options['target_id'])
+
+        rebuilt = 0
+        for target_id in targets.values_list('id', flat=True).iterator():
+            rebuild_photometry_summary(target_id)
+            rebuilt += 1
+
+        self.stdout.write(f'Rebuilt {rebuilt} photometry summaries')
@@ -0,0 +1,74 @@
+import os
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+
+from custom_code.jobs import claim_job, run_job, requeue_stale_jobs, send_heartbeat, JOB_HEARTBEAT_INTERVAL
+from custom_code.fleet import terminate_fleet_processes
+from custom_code.spikepipe_pool import shutdown_spikepipe_executor
+
+
+def _run_job_in_thread(job):
+    close_old_connections()
+    try:
+        run_job(job)
+    finally:
+        connection.close()
+
+
+class Command(BaseCommand):
+    """
+    This management command runs the FLEET and spikepipe jobs queued by the hooks. At most ``--concurrency`` jobs
+    run at once in each worker; start more workers (on the same or other machines) to process the queue faster.
+
+    Example: ./manage.py runworker --concurrency 2
+    """
+
+    help = 'Runs queued FLEET and spikepipe jobs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=2, help='Maximum number of jobs to run at once')
+        parser.add_argument('--poll-interval', type=float, default=5., help='Seconds between checks of the queue')
+        parser.add_argument('--burst', action='store_true', help='Exit once the queue is empty')
+
+    def handle(self, *args, **options):
+        concurrency = max(options['concurrency'], 1)
+        worker = f'{socket.gethostname()}:{os.getpid()}'
+
+        self._requeue_stale_jobs(worker)
+        self.stdout.write(f'Worker {worker} running up to {concurrency} jobs at once')
+
+        running = set()
+        last_heartbeat = time.monotonic()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            try:
+                while True:
+                    close_old_connections()
+                    if time.monotonic() - last_heartbeat > JOB_HEARTBEAT_INTERVAL.total_seconds():
+                        send_heartbeat(worker)
+                        self._requeue_stale_jobs()
+                        last_heartbeat = time.monotonic()
+
+                    running = {future for future in running if not future.done()}
+                    job = claim_job(worker) if len(running) < concurrency else None
+                    if job is not None:
+                        self.stdout.write(f'Starting {job}')
+                        running.add(executor.submit(_run_job_in_thread, job))
+                    elif running:
+                        wait(running, timeout=options['poll_interval'], return_when=FIRST_COMPLETED)
+                    elif options['burst']:
+                        break
+                    else:
+                        time.sleep(options['poll_interval'])
+            finally:
+                # Do not leave FLEET and spikepipe processes behind when the worker is stopped
+                terminate_fleet_processes()
+                shutdown_spikepipe_executor()
+
+    def _requeue_stale_jobs(self, worker=None):
+        requeued, failed = requeue_stale_jobs(worker)
+        if requeued or failed:
+            self.stdout.write(f'Requeued {requeued} and failed {failed} stale jobs')
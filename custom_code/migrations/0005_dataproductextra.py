@@ -0,0 +1,32 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tom_targets', '0018_auto_20200714_1832'),
+        ('tom_dataproducts', '0010_manual_20210305_fix_spectroscopy'),
+        ('custom_code', '0004_auto_20210409_2218'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DataProductExtra',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('data_type', models.CharField(db_index=True, default='', help_text='Type of data (either photometry or spectroscopy)', max_length=100, verbose_name='Data Type')),
+                ('instrument', models.CharField(blank=True, db_index=True, default='', max_length=100, verbose_name='Instrument')),
+                ('reducer_group', models.CharField(blank=True, db_index=True, default='', max_length=100, verbose_name='Reducer Group')),
+                ('photometry_type', models.CharField(blank=True, db_index=True, default='', max_length=100, verbose_name='Photometry Type')),
+                ('used_in', models.CharField(blank=True, default='', max_length=200, verbose_name='Used In')),
+                ('final_reduction', models.BooleanField(db_index=True, default=False, verbose_name='Final Reduction')),
+                ('data_product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='tom_dataproducts.dataproduct')),
+                ('reduced_datum_extra', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='custom_code.reduceddatumextra')),
+                ('target', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='tom_targets.target')),
+            ],
+            options={
+                'get_latest_by': ('id',),
+            },
+        ),
+    ]
@@ -0,0 +1,42 @@
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tom_targets', '0018_auto_20200714_1832'),
+        ('tom_dataproducts', '0010_manual_20210305_fix_spectroscopy'),
+        ('custom_code', '0005_dataproductextra'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BackgroundJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task', models.CharField(help_text='Name of the task in custom_code.jobs.JOB_TASKS', max_length=50, verbose_name='Task')),
+                ('kwargs', models.JSONField(blank=True, default=dict, help_text='Keyword arguments passed to the task', verbose_name='Keyword Arguments')),
+                ('dedupe_key', models.CharField(help_text='Jobs with the same key are never queued twice', max_length=100, verbose_name='Dedupe Key')),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('finished', 'Finished'), ('failed', 'Failed')], db_index=True, default='queued', max_length=10)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('max_attempts', models.PositiveIntegerField(default=3)),
+                ('run_after', models.DateTimeField(db_index=True, default=django.utils.timezone.now, help_text='Jobs are not started before this time')),
+                ('error', models.TextField(blank=True, default='')),
+                ('worker', models.CharField(blank=True, default='', max_length=100)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('started', models.DateTimeField(blank=True, null=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('data_product', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='tom_dataproducts.dataproduct')),
+                ('target', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='tom_targets.target')),
+            ],
+            options={
+                'get_latest_by': ('id',),
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='backgroundjob',
+            constraint=models.UniqueConstraint(condition=models.Q(status__in=('queued', 'running')), fields=('dedupe_key',), name='unique_active_job'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tom_dataproducts', '0010_manual_20210305_fix_spectroscopy'),
+        ('custom_code', '0006_backgroundjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BinarySpectrum',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('data', models.BinaryField(help_text='Wavelength and flux arrays, as little-endian float32', verbose_name='Data')),
+                ('reduced_datum', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='tom_dataproducts.reduceddatum')),
+            ],
+        ),
+    ]
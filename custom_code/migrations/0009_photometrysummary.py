@@ -0,0 +1,35 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tom_targets', '0018_auto_20200714_1832'),
+        ('custom_code', '0008_spectrumpreview'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PhotometrySummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.IntegerField(default=0, verbose_name='Number of Points')),
+                ('filter_counts', models.JSONField(default=dict, verbose_name='Number of Points per Filter')),
+                ('first_timestamp', models.DateTimeField(blank=True, null=True)),
+                ('first_magnitude', models.FloatField(blank=True, null=True)),
+                ('first_filter', models.CharField(blank=True, default='', max_length=100)),
+                ('latest_timestamp', models.DateTimeField(blank=True, null=True)),
+                ('latest_magnitude', models.FloatField(blank=True, null=True)),
+                ('latest_filter', models.CharField(blank=True, default='', max_length=100)),
+                ('peak_timestamp', models.DateTimeField(blank=True, null=True)),
+                ('peak_magnitude', models.FloatField(blank=True, help_text='Brightest magnitude that is not an upper limit', null=True)),
+                ('peak_filter', models.CharField(blank=True, default='', max_length=100)),
+                ('first_detection', models.DateTimeField(blank=True, null=True)),
+                ('last_detection', models.DateTimeField(blank=True, null=True)),
+                ('has_subtracted', models.BooleanField(default=False, verbose_name='Has Background Subtracted Photometry')),
+                ('modified', models.DateTimeField(auto_now=True)),
+                ('target', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='tom_targets.target')),
+            ],
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('custom_code', '0009_photometrysummary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backgroundjob',
+            name='heartbeat',
+            field=models.DateTimeField(blank=True, help_text='Last time the worker running the job was seen alive', null=True),
+        ),
+    ]
@@ -0,0 +1,40 @@
+from django.db import migrations
+
+
+def backfill_dataproduct_extras(apps, schema_editor):
+    """
+    Creates the DataProductExtra row of every existing 'upload_extras'
+    ReducedDatumExtra that does not have one yet
+    """
+    from custom_code.models import DataProductExtra as CurrentDataProductExtra
+
+    DataProduct = apps.get_model('tom_dataproducts', 'DataProduct')
+    DataProductExtra = apps.get_model('custom_code', 'DataProductExtra')
+    ReducedDatumExtra = apps.get_model('custom_code', 'ReducedDatumExtra')
+
+    data_product_ids = set(DataProduct.objects.values_list('id', flat=True))
+    data_product_ids -= set(DataProductExtra.objects.values_list('data_product_id', flat=True))
+
+    # Later extras of the same DataProduct replace earlier ones, like ReducedDatumExtra.save does
+    fields_by_data_product_id = {}
+    reduced_datum_extras = ReducedDatumExtra.objects.filter(key='upload_extras').order_by('id')
+    for reduced_datum_extra in reduced_datum_extras.iterator(chunk_size=1000):
+        fields = CurrentDataProductExtra.get_fields(reduced_datum_extra)
+        if fields is not None and fields['data_product_id'] in data_product_ids:
+            fields_by_data_product_id[fields['data_product_id']] = fields
+
+    DataProductExtra.objects.bulk_create(
+        [DataProductExtra(**fields) for fields in fields_by_data_product_id.values()], batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tom_dataproducts', '0010_manual_20210305_fix_spectroscopy'),
+        ('custom_code', '0010_backgroundjob_heartbeat'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_dataproduct_extras, migrations.RunPython.noop),
+    ]
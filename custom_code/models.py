@@ -1,6 +1,8 @@
 from django.db import models
-from tom_dataproducts.models import ReducedDatum
+from django.utils import timezone
+from tom_dataproducts.models import DataProduct, ReducedDatum
 from tom_targets.models import Target
+from custom_code.cache import invalidate_target_plots
 
 # Create your models here.
 
@@ -44,7 +46,11 @@ class ReducedDatumExtra(models.Model):
     def __str__(self):
         return f'{self.key}: {self.value}'
 
-    def save(self, *args, **kwargs):
+    def set_typed_values(self):
+        """
+        Fills in ``float_value`` and ``bool_value`` from ``value``. Called by
+        ``save``, and must be called before ``bulk_create``.
+        """
         try:
             self.float_value = float(self.value)
         except (TypeError, ValueError, OverflowError):
@@ -54,7 +60,95 @@ class ReducedDatumExtra(models.Model):
         except (TypeError, ValueError, OverflowError):
             self.bool_value = None
 
+    def save(self, *args, **kwargs):
+        self.set_typed_values()
         super().save(*args, **kwargs)
+        if self.key == 'upload_extras':
+            DataProductExtra.sync(self)
+        invalidate_target_plots(self.target_id)
+
+
+class DataProductExtra(models.Model):
+    """
+    Typed, indexed copy of the 'upload_extras' ReducedDatumExtra of a
+    DataProduct. Rows are kept in sync by ``ReducedDatumExtra.save``.
+    """
+
+    data_product = models.OneToOneField(
+        DataProduct, on_delete=models.CASCADE
+    )
+    target = models.ForeignKey(
+        Target, on_delete=models.CASCADE
+    )
+    reduced_datum_extra = models.OneToOneField(
+        ReducedDatumExtra, on_delete=models.CASCADE
+    )
+    data_type = models.CharField(
+        max_length=100, default='', verbose_name='Data Type', db_index=True,
+        help_text='Type of data (either photometry or spectroscopy)'
+    )
+    instrument = models.CharField(
+        max_length=100, default='', blank=True, verbose_name='Instrument', db_index=True
+    )
+    reducer_group = models.CharField(
+        max_length=100, default='', blank=True, verbose_name='Reducer Group', db_index=True
+    )
+    photometry_type = models.CharField(
+        max_length=100, default='', blank=True, verbose_name='Photometry Type', db_index=True
+    )
+    used_in = models.CharField(
+        max_length=200, default='', blank=True, verbose_name='Used In'
+    )
+    final_reduction = models.BooleanField(
+        default=False, verbose_name='Final Reduction', db_index=True
+    )
+
+    class Meta:
+        get_latest_by = ('id',)
+
+    def __str__(self):
+        return f'{self.data_product_id}: {self.instrument} {self.photometry_type}'
+
+    @staticmethod
+    def get_fields(reduced_datum_extra):
+        """
+        Returns the field values of the row matching an 'upload_extras'
+        ReducedDatumExtra, or None if it has no valid data_product_id.
+        """
+        value = reduced_datum_extra.value
+        if not isinstance(value, dict):
+            return None
+        try:
+            data_product_id = int(value.get('data_product_id', ''))
+        except (TypeError, ValueError):
+            return None
+        return {
+            'data_product_id': data_product_id,
+            'target_id': reduced_datum_extra.target_id,
+            'reduced_datum_extra': reduced_datum_extra,
+            'data_type': reduced_datum_extra.data_type,
+            'instrument': str(value.get('instrument', '') or ''),
+            'reducer_group': str(value.get('reducer_group', '') or ''),
+            'photometry_type': str(value.get('photometry_type', '') or ''),
+            'used_in': str(value.get('used_in', '') or ''),
+            'final_reduction': value.get('final_reduction', '') == True
+        }
+
+    @classmethod
+    def sync(cls, reduced_datum_extra):
+        """
+        Creates or updates the row matching an 'upload_extras' ReducedDatumExtra.
+        Returns None if the extra does not point to an existing DataProduct.
+        """
+        fields = cls.get_fields(reduced_datum_extra)
+        if fields is None:
+            return None
+        data_product_id = fields.pop('data_product_id')
+        if not DataProduct.objects.filter(id=data_product_id).exists():
+            return None
+
+        data_product_extra, _ = cls.objects.update_or_create(data_product_id=data_product_id, defaults=fields)
+        return data_product_extra
 
 
 class ScienceTags(models.Model):
@@ -118,3 +212,171 @@ class Papers(models.Model):
 
     class Meta:
         get_latest_by = ('id',)
+
+
+JOB_STATUS_CHOICES = (
+    ('queued', 'Queued'),
+    ('running', 'Running'),
+    ('finished', 'Finished'),
+    ('failed', 'Failed')
+)
+
+JOB_ACTIVE_STATUSES = ('queued', 'running')
+
+
+class BackgroundJob(models.Model):
+    """
+    A FLEET or spikepipe run waiting for, or processed by, ``manage.py runworker``.
+    At most one job with the same ``dedupe_key`` can be queued or running at a time.
+    """
+
+    task = models.CharField(
+        max_length=50, verbose_name='Task', help_text='Name of the task in custom_code.jobs.JOB_TASKS'
+    )
+    target = models.ForeignKey(
+        Target, on_delete=models.CASCADE
+    )
+    data_product = models.ForeignKey(
+        DataProduct, on_delete=models.CASCADE, null=True, blank=True
+    )
+    kwargs = models.JSONField(
+        default=dict, blank=True, verbose_name='Keyword Arguments',
+        help_text='Keyword arguments passed to the task'
+    )
+    dedupe_key = models.CharField(
+        max_length=100, verbose_name='Dedupe Key',
+        help_text='Jobs with the same key are never queued twice'
+    )
+    status = models.CharField(
+        max_length=10, choices=JOB_STATUS_CHOICES, default='queued', db_index=True
+    )
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    run_after = models.DateTimeField(
+        default=timezone.now, db_index=True, help_text='Jobs are not started before this time'
+    )
+    error = models.TextField(default='', blank=True)
+    worker = models.CharField(max_length=100, default='', blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    heartbeat = models.DateTimeField(
+        null=True, blank=True, help_text='Last time the worker running the job was seen alive'
+    )
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        get_latest_by = ('id',)
+        constraints = [
+            models.UniqueConstraint(
+                fields=['dedupe_key'], condition=models.Q(status__in=JOB_ACTIVE_STATUSES), name='unique_active_job'
+            )
+        ]
+
+    def __str__(self):
+        return f'{self.task} on {self.target_id} ({self.status})'
+
+
+class BinarySpectrum(models.Model):
+    """
+    Copy of the wavelength and flux of a spectroscopy ReducedDatum as float32
+    arrays, saved alongside its JSON value when SPECTRUM_STORAGE is 'binary'.
+    See custom_code.spectra.
+    """
+
+    reduced_datum = models.OneToOneField(
+        ReducedDatum, on_delete=models.CASCADE
+    )
+    data = models.BinaryField(
+        verbose_name='Data', help_text='Wavelength and flux arrays, as little-endian float32'
+    )
+
+    def __str__(self):
+        return f'Binary spectrum of {self.reduced_datum_id}'
+
+
+class SpectrumPreview(models.Model):
+    """
+    Downsampled copy of a spectroscopy ReducedDatum keeping the minimum and
+    maximum flux of each wavelength bin, used for thumbnail plots.
+    See custom_code.spectra.
+    """
+
+    reduced_datum = models.OneToOneField(
+        ReducedDatum, on_delete=models.CASCADE
+    )
+    data = models.BinaryField(
+        verbose_name='Data', help_text='Wavelength and flux arrays, as little-endian float32'
+    )
+
+    def __str__(self):
+        return f'Preview of {self.reduced_datum_id}'
+
+
+class PhotometrySummary(models.Model):
+    """
+    Summary of the photometry of a target, updated as photometry is added
+    and rebuilt when it is removed, so that lists of targets do not have to
+    scan every point. See custom_code.photometry.
+    """
+
+    target = models.OneToOneField(
+        Target, on_delete=models.CASCADE
+    )
+    count = models.IntegerField(
+        default=0, verbose_name='Number of Points'
+    )
+    filter_counts = models.JSONField(
+        default=dict, verbose_name='Number of Points per Filter'
+    )
+    first_timestamp = models.DateTimeField(null=True, blank=True)
+    first_magnitude = models.FloatField(null=True, blank=True)
+    first_filter = models.CharField(max_length=100, default='', blank=True)
+    latest_timestamp = models.DateTimeField(null=True, blank=True)
+    latest_magnitude = models.FloatField(null=True, blank=True)
+    latest_filter = models.CharField(max_length=100, default='', blank=True)
+    peak_timestamp = models.DateTimeField(null=True, blank=True)
+    peak_magnitude = models.FloatField(
+        null=True, blank=True, help_text='Brightest magnitude that is not an upper limit'
+    )
+    peak_filter = models.CharField(max_length=100, default='', blank=True)
+    first_detection = models.DateTimeField(null=True, blank=True)
+    last_detection = models.DateTimeField(null=True, blank=True)
+    has_subtracted = models.BooleanField(
+        default=False, verbose_name='Has Background Subtracted Photometry'
+    )
+    modified = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'Photometry summary of {self.target_id}'
+
+    def add_point(self, timestamp, value):
+        """
+        Adds one photometry point, given by the timestamp and value of its
+        ReducedDatum, to the summary
+        """
+        filter_name = str(value.get('filter', '') or '')
+        self.count += 1
+        self.filter_counts[filter_name] = self.filter_counts.get(filter_name, 0) + 1
+        if value.get('background_subtracted', '') == True:
+            self.has_subtracted = True
+
+        try:
+            magnitude = float(value['magnitude'])
+        except (KeyError, TypeError, ValueError):
+            return
+        if magnitude != magnitude:  # NaN
+            return
+
+        if self.first_timestamp is None or timestamp < self.first_timestamp:
+            self.first_timestamp, self.first_magnitude, self.first_filter = timestamp, magnitude, filter_name
+        if self.latest_timestamp is None or timestamp >= self.latest_timestamp:
+            self.latest_timestamp, self.latest_magnitude, self.latest_filter = timestamp, magnitude, filter_name
+
+        if value.get('upperlimit', '') in (True, 'True'):
+            return
+        if self.peak_magnitude is None or magnitude < self.peak_magnitude:
+            self.peak_timestamp, self.peak_magnitude, self.peak_filter = timestamp, magnitude, filter_name
+        if self.first_detection is None or timestamp < self.first_detection:
+            self.first_detection = timestamp
+        if self.last_detection is None or timestamp > self.last_detection:
+            self.last_detection = timestamp
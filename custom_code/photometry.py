@@ -0,0 +1,311 @@
+from django.db import transaction
+from tom_dataproducts.models import ReducedDatum
+from custom_code.models import DataProductExtra, PhotometrySummary
+from custom_code.cache import get_data_version
+from collections import OrderedDict
+from datetime import timezone
+import numpy as np
+import threading
+import hashlib
+import json
+
+NUMERIC_KEYS = ('magnitude', 'error')
+
+SNAPSHOT_KEYS = ('filter', 'magnitude', 'error', 'upperlimit', 'background_subtracted', 'subtraction_algorithm',
+                 'template_source', 'reduction_type')
+
+EXTRA_FIELDS = ('data_product_id', 'instrument', 'photometry_type', 'reducer_group', 'used_in', 'final_reduction')
+
+# Keys of the photometry value used by PhotometrySummary
+SUMMARY_KEYS = ('filter', 'magnitude', 'upperlimit', 'background_subtracted')
+
+# Number of rows inserted per query by bulk_create_photometry
+BULK_CREATE_BATCH_SIZE = 1000
+
+# Photometry snapshots of the most recently viewed targets, keyed by target id
+PHOTOMETRY_SNAPSHOT_CACHE_SIZE = 32
+_snapshot_cache = OrderedDict()
+_snapshot_lock = threading.Lock()
+
+
+def _as_float(x):
+    try:
+        return float(x)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def get_photometry_columns(datums, keys=('filter', 'magnitude', 'error'), fields=()):
+    """
+    Fetches only the timestamp and the requested keys of the photometry
+    ``value`` of each ReducedDatum, without building model instances.
+
+    Numeric keys are returned as float arrays (missing or non-numeric values,
+    such as '' or '>19.5', become NaN), every other key as an object array
+    where missing values become ''.
+
+    :param datums: photometry ReducedDatums
+    :type datums: QuerySet
+
+    :param keys: keys of ``ReducedDatum.value`` to fetch
+    :type keys: tuple
+
+    :param fields: ReducedDatum fields to fetch, returned unchanged
+    :type fields: tuple
+
+    :returns: dictionary of numpy arrays keyed by 'timestamp', each field and each key
+    :rtype: dict
+    """
+    names = ('timestamp',) + tuple(fields) + tuple(keys)
+    rows = list(datums.values_list('timestamp', *fields, *['value__' + key for key in keys]))
+    columns = list(zip(*rows)) if rows else [()] * len(names)
+
+    photometry = {}
+    for name, column in zip(names, columns):
+        if name in NUMERIC_KEYS:
+            photometry[name] = np.array([_as_float(x) for x in column], dtype=float)
+        elif name in keys:
+            photometry[name] = np.array(['' if x is None else x for x in column], dtype=object)
+        else:
+            photometry[name] = np.array(column, dtype=object)
+    return photometry
+
+
+def get_photometry_snapshot(target_id):
+    """
+    Returns all of the photometry of a target as columns, along with the
+    values of its photometry upload extras, for interactive filtering.
+
+    Snapshots are kept in a bounded in-process LRU and rebuilt whenever the
+    data version of the target changes.
+
+    :returns: dictionary with the photometry columns under 'photometry' and
+        the list of DataProductExtra values under 'extras'
+    :rtype: dict
+    """
+    version = get_data_version(target_id)
+    with _snapshot_lock:
+        cached = _snapshot_cache.get(target_id)
+        if cached is not None and cached[0] == version:
+            _snapshot_cache.move_to_end(target_id)
+            return cached[1]
+
+    datums = ReducedDatum.objects.filter(target_id=target_id, data_type='photometry')
+    extras = DataProductExtra.objects.filter(target_id=target_id, data_type='photometry')
+    snapshot = {
+        'photometry': get_photometry_columns(datums, SNAPSHOT_KEYS, fields=('data_product_id',)),
+        'extras': list(extras.values(*EXTRA_FIELDS))
+    }
+
+    with _snapshot_lock:
+        _snapshot_cache[target_id] = (version, snapshot)
+        _snapshot_cache.move_to_end(target_id)
+        while len(_snapshot_cache) > PHOTOMETRY_SNAPSHOT_CACHE_SIZE:
+            _snapshot_cache.popitem(last=False)
+
+    return snapshot
+
+
+def group_photometry_by_filter(photometry, mask=None):
+    """
+    Groups columnar photometry by filter, skipping points without a magnitude.
+
+    :param photometry: dictionary returned by ``get_photometry_columns``
+    :type photometry: dict
+
+    :param mask: boolean array selecting the points to include
+    :type mask: numpy array
+
+    :returns: {filter: {'time': array, 'magnitude': array, 'error': array, 'upperlimit': array}},
+        where 'upperlimit' is only there if it was fetched
+    :rtype: dict
+    """
+    if not photometry:
+        return {}
+
+    selected = ~np.isnan(photometry['magnitude'])
+    if mask is not None:
+        selected &= mask
+
+    columns = {
+        'time': photometry['timestamp'][selected],
+        'magnitude': photometry['magnitude'][selected],
+        'error': photometry['error'][selected]
+    }
+    if 'upperlimit' in photometry:
+        upperlimit = photometry['upperlimit'][selected]
+        columns['upperlimit'] = (upperlimit == True) | (upperlimit == 'True')
+    filters = photometry['filter'][selected]
+
+    photometry_data = {}
+    for filter_name in dict.fromkeys(filters):
+        in_filter = filters == filter_name
+        photometry_data[filter_name] = {key: column[in_filter] for key, column in columns.items()}
+    return photometry_data
+
+
+def get_photometry(datums):
+    """
+    Returns the photometry of ``datums`` grouped by filter, as NumPy arrays
+    """
+    return group_photometry_by_filter(get_photometry_columns(datums, ('filter', 'magnitude', 'error', 'upperlimit')))
+
+
+def lttb_indices(x, y, n_out):
+    """
+    Returns the indices of the ``n_out`` points chosen by the
+    largest-triangle-three-buckets algorithm, which keeps the visual shape of
+    a curve. ``x`` must be sorted.
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    indices = np.empty(n_out, dtype=int)
+    indices[0], indices[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        next_x, next_y = x[end:next_end].mean(), y[end:next_end].mean()
+        area = np.abs((x[a] - next_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (next_y - y[a]))
+        a = start + int(np.argmax(area))
+        indices[i + 1] = a
+    return indices
+
+
+def _decimate_points(x, y, indices, n_out):
+    """
+    Returns at most ``n_out`` of ``indices``, sorted by time, chosen with LTTB,
+    or the newest ones if there are too few to pick with LTTB
+    """
+    indices = indices[np.argsort(x[indices], kind='stable')]
+    if n_out >= len(indices):
+        return indices
+    if n_out < 3:
+        return indices[len(indices) - n_out:]
+    return indices[lttb_indices(x[indices], y[indices], n_out)]
+
+
+def decimate_photometry(photometry_data, max_points):
+    """
+    Reduces each filter of ``photometry_data`` to at most ``max_points``
+    points with LTTB, and the errors of the kept points are kept with them.
+    Upper limits are all kept if they fit next to the detections; otherwise
+    they get the budget left by the detections, and at least half of it, and
+    are decimated separately.
+
+    :param photometry_data: dictionary returned by ``group_photometry_by_filter``
+    :type photometry_data: dict
+
+    :param max_points: maximum number of points per filter, or 0 to keep every point
+    :type max_points: int
+    """
+    if not max_points:
+        return photometry_data
+
+    decimated = {}
+    for filter_name, values in photometry_data.items():
+        n = len(values['magnitude'])
+        if n <= max_points:
+            decimated[filter_name] = values
+            continue
+
+        upperlimit = values.get('upperlimit', np.zeros(n, dtype=bool))
+        x = np.fromiter((time.timestamp() for time in values['time']), dtype=float, count=n)
+        detections = np.flatnonzero(~upperlimit)
+        limits = np.flatnonzero(upperlimit)
+        n_detections = min(len(detections), max(max_points - len(limits), max_points // 2))
+        keep = np.concatenate([
+            _decimate_points(x, values['magnitude'], detections, n_detections),
+            _decimate_points(x, values['magnitude'], limits, max_points - n_detections)
+        ])
+        keep = np.sort(keep)
+        decimated[filter_name] = {key: column[keep] for key, column in values.items()}
+    return decimated
+
+
+def get_datum_hash(timestamp, value, source_name):
+    """
+    Returns a hash of the content of a photometry ReducedDatum, used to
+    skip points that are already in the database.
+    """
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    content = json.dumps([timestamp.isoformat(), value, source_name], sort_keys=True)
+    return hashlib.sha1(content.encode()).hexdigest()
+
+
+def bulk_create_photometry(target, reduced_data):
+    """
+    Saves the photometry ReducedDatums of a target that are not in the
+    database yet, in batches of ``BULK_CREATE_BATCH_SIZE``.
+
+    Existing points are identified by the hash of their timestamp, value and
+    source name, so the whole import needs a single SELECT plus one INSERT per
+    batch instead of a ``get_or_create`` per point. Unlike ``save``, this does
+    not validate the data type of each datum.
+
+    :param target: target the photometry belongs to
+    :type target: Target
+
+    :param reduced_data: unsaved photometry ReducedDatums of ``target``
+    :type reduced_data: list
+
+    :returns: the ReducedDatums that were created
+    :rtype: list
+    """
+    existing = ReducedDatum.objects.filter(target=target, data_type='photometry')
+    seen = {get_datum_hash(*row) for row in existing.values_list('timestamp', 'value', 'source_name')}
+
+    new_data = []
+    for rd in reduced_data:
+        datum_hash = get_datum_hash(rd.timestamp, rd.value, rd.source_name)
+        if datum_hash not in seen:
+            seen.add(datum_hash)
+            new_data.append(rd)
+
+    created = ReducedDatum.objects.bulk_create(new_data, batch_size=BULK_CREATE_BATCH_SIZE)
+    update_photometry_summary(target.id, created)
+    return created
+
+
+def _as_utc(timestamp):
+    if timestamp.tzinfo is None:  # naive timestamps are saved as UTC
+        return timestamp.replace(tzinfo=timezone.utc)
+    return timestamp
+
+
+def update_photometry_summary(target_id, reduced_data):
+    """
+    Adds newly created photometry ReducedDatums of a target to its
+    PhotometrySummary. Saving a ReducedDatum does this through a signal (see
+    custom_code.signals), but ``bulk_create`` does not send signals, so this
+    must be called after bulk creating photometry.
+    """
+    reduced_data = [rd for rd in reduced_data if rd.data_type == 'photometry']
+    if not reduced_data:
+        return
+    with transaction.atomic():
+        summary, _ = PhotometrySummary.objects.select_for_update().get_or_create(target_id=target_id)
+        for rd in reduced_data:
+            summary.add_point(_as_utc(rd.timestamp), rd.value)
+        summary.save()
+
+
+def rebuild_photometry_summary(target_id):
+    """
+    Recomputes the PhotometrySummary of a target from all of its photometry.
+    Deleting or changing a ReducedDatum does this through a signal, but not
+    ``QuerySet.update`` or raw SQL.
+    """
+    datums = ReducedDatum.objects.filter(target_id=target_id, data_type='photometry')
+    rows = datums.values_list('timestamp', *['value__' + key for key in SUMMARY_KEYS])
+    with transaction.atomic():
+        existing, _ = PhotometrySummary.objects.select_for_update().get_or_create(target_id=target_id)
+        summary = PhotometrySummary(id=existing.id, target_id=target_id)
+        for timestamp, *values in rows.iterator(chunk_size=BULK_CREATE_BATCH_SIZE):
+            summary.add_point(_as_utc(timestamp), {k: v for k, v in zip(SUMMARY_KEYS, values) if v is not None})
+        summary.save()
+    return summary
@@ -0,0 +1,38 @@
+import os
+
+import plotly
+from plotly import offline
+from django.contrib.staticfiles.finders import BaseFinder
+from django.core.files.storage import FileSystemStorage
+
+# plotly.js is loaded once per page by base.html from this static path, which
+# changes with the version of plotly so that browsers can cache it forever
+PLOTLY_JS = f'plotly/{plotly.__version__}/plotly.min.js'
+PLOTLY_JS_SOURCE = os.path.join(os.path.dirname(plotly.__file__), 'package_data', 'plotly.min.js')
+
+
+def render_figure(figure, **kwargs):
+    """
+    Returns the HTML div of a Plotly figure, which only holds the figure
+    itself; plotly.js is not included.
+    """
+    return offline.plot(figure, output_type='div', show_link=False, include_plotlyjs=False, **kwargs)
+
+
+class PlotlyJSFinder(BaseFinder):
+    """
+    Static files finder that serves the plotly.js bundled with the plotly
+    package, the same version that renders the figures, at ``PLOTLY_JS``
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.storage = FileSystemStorage(location=os.path.dirname(PLOTLY_JS_SOURCE))
+        self.storage.prefix = os.path.dirname(PLOTLY_JS)
+
+    def find(self, path, all=False):
+        if path != PLOTLY_JS:
+            return []
+        return [PLOTLY_JS_SOURCE] if all else PLOTLY_JS_SOURCE
+
+    def list(self, ignore_patterns):
+        yield os.path.basename(PLOTLY_JS_SOURCE), self.storage
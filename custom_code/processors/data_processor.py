@@ -1,10 +1,13 @@
 from importlib import import_module
 from django.conf import settings
 from tom_dataproducts.models import ReducedDatum
+from custom_code.cache import invalidate_target_plots
+from custom_code.spectra import store_spectra
+from custom_code.photometry import update_photometry_summary
 
 DEFAULT_DATA_PROCESSOR_CLASS = 'tom_dataproducts.data_processor.DataProcessor'
 
-def run_custom_data_processor(dp, extras):
+def run_custom_data_processor(dp, extras, **kwargs):
     try:
         processor_class = settings.DATA_PROCESSORS[dp.data_product_type]
     except Exception:
@@ -18,11 +21,19 @@ def run_custom_data_processor(dp, extras):
         raise ImportError('Could not import {}. Did you provide the correct path?'.format(processor_class))
 
     data_processor = clazz()
-    data = data_processor.process_data(dp, extras)
-
-    reduced_datums = [ReducedDatum(target=dp.target, data_product=dp, data_type=dp.data_product_type,
-                                   timestamp=datum[0], value=datum[1]) for datum in data]
-    ReducedDatum.objects.bulk_create(reduced_datums)
+    # Processors that can read large files in chunks are saved one chunk at a time
+    if hasattr(data_processor, 'process_data_in_chunks'):
+        chunks = data_processor.process_data_in_chunks(dp, extras, **kwargs)
+    else:
+        chunks = [data_processor.process_data(dp, extras, **kwargs)]
+
+    for data in chunks:
+        reduced_datums = [ReducedDatum(target=dp.target, data_product=dp, data_type=dp.data_product_type,
+                                       timestamp=datum[0], value=datum[1]) for datum in data]
+        ReducedDatum.objects.bulk_create(reduced_datums)
+        update_photometry_summary(dp.target_id, reduced_datums)
+    store_spectra(ReducedDatum.objects.filter(data_product=dp))
+    invalidate_target_plots(dp.target_id)
 
     return ReducedDatum.objects.filter(data_product=dp)
 
@@ -1,9 +1,11 @@
 import mimetypes
 import json
+from datetime import timezone
 
-from astropy import units
+import numpy as np
 from astropy.io import ascii
-from astropy.time import Time, TimezoneInfo
+from astropy.io.ascii.fastbasic import FastBasic
+from astropy.time import Time
 from django.core.files.storage import default_storage
 
 from tom_dataproducts.data_processor import DataProcessor
@@ -12,39 +14,86 @@ from tom_dataproducts.exceptions import InvalidFileFormatException
 
 class PhotometryProcessor(DataProcessor):
 
+    COLUMN_NAMES = ['time', 'filter', 'magnitude', 'error']
+
+    # Files larger than this are read and saved in chunks of CHUNK_SIZE characters,
+    # so that memory stays bounded. Their format is guessed from the first
+    # FORMAT_GUESS_LINES lines.
+    CHUNKED_FILE_SIZE = 10 * 1024 * 1024  # bytes
+    CHUNK_SIZE = 1024 * 1024
+    FORMAT_GUESS_LINES = 100
+
     def process_data(self, data_product, extras):
+        return [datum for chunk in self.process_data_in_chunks(data_product, extras) for datum in chunk]
 
+    def process_data_in_chunks(self, data_product, extras):
+        """
+        Same as ``process_data``, but yields the photometry of large files in
+        several lists, which ``run_custom_data_processor`` saves one by one
+        """
         mimetype = mimetypes.guess_type(data_product.data.name)[0]
-        if mimetype in self.PLAINTEXT_MIMETYPES:
-            photometry = self._process_photometry_from_plaintext(data_product, extras)
-            return [(datum.pop('timestamp'), datum) for datum in photometry]
-        else:
+        if mimetype not in self.PLAINTEXT_MIMETYPES:
             raise InvalidFileFormatException('Unsupported file type')
 
-    def _process_photometry_from_plaintext(self, data_product, extras):
+        for photometry in self._process_photometry_from_plaintext(data_product, extras):
+            yield [(datum.pop('timestamp'), datum) for datum in photometry]
 
-        photometry = []
+    def _guess_reader(self, lines):
+        """
+        Returns the reader class and the delimiter and quote character that
+        ``ascii.read`` guesses for the given lines
+        """
+        ascii.read(lines, names=self.COLUMN_NAMES)
+        kwargs = next(trace['kwargs'] for trace in ascii.get_read_trace() if trace['status'].startswith('Success'))
+        reader = kwargs.get('reader_cls', kwargs.get('Reader'))
+        return reader, {key: kwargs[key] for key in ('delimiter', 'quotechar') if key in kwargs}
 
+    def _read_plaintext(self, data_product):
         data_aws = default_storage.open(data_product.data.name, 'r')
-        data = ascii.read(data_aws.read(),
-                          names=['time', 'filter', 'magnitude', 'error'])
+        if default_storage.size(data_product.data.name) <= self.CHUNKED_FILE_SIZE:
+            yield ascii.read(data_aws.read(), names=self.COLUMN_NAMES)
+            return
 
-        if len(data) < 1:
-            raise InvalidFileFormatException('Empty table or invalid file type')
+        lines = data_aws.read(self.CHUNK_SIZE).splitlines()  # the last line may be incomplete
+        reader, reader_kwargs = self._guess_reader(lines[:min(self.FORMAT_GUESS_LINES, len(lines) - 1) or 1])
+        data_aws.seek(0)
+        if issubclass(reader, FastBasic):
+            yield from ascii.read(data_aws, format=reader._format_name, names=self.COLUMN_NAMES, guess=False,
+                                  fast_reader={'chunk_size': self.CHUNK_SIZE, 'chunk_generator': True},
+                                  **reader_kwargs)
+        else:
+            # Only the fast readers can read in chunks
+            yield ascii.read(data_aws.read(), format=reader._format_name, names=self.COLUMN_NAMES, guess=False,
+                             **reader_kwargs)
+
+    def _process_photometry_from_plaintext(self, data_product, extras):
+        """
+        Yields lists of photometry dictionaries, converting the times of each
+        table at once instead of row by row
+        """
+        empty = True
 
-        for datum in data:
-            time = Time(float(datum['time']), format='mjd')
-            utc = TimezoneInfo(utc_offset=0*units.hour)
-            time.format = 'datetime'
-            value = {
-                'timestamp': time.to_datetime(timezone=utc),
-                'magnitude': datum['magnitude'],
-                'filter': datum['filter'],
-                'error': datum['error']
-            }
-            value.update(extras)
+        for data in self._read_plaintext(data_product):
+            if len(data) < 1:
+                continue
+            empty = False
 
-            photometry.append(value)
+            # Converting to naive datetimes is much faster than passing a timezone to to_datetime
+            timestamps = Time(np.asarray(data['time'], dtype=float), format='mjd').to_datetime()
+            timestamps = [timestamp.replace(tzinfo=timezone.utc) for timestamp in timestamps]
+            columns = zip(timestamps, data['magnitude'].tolist(), data['filter'].tolist(), data['error'].tolist())
 
-        return photometry
+            photometry = []
+            for timestamp, magnitude, filter_name, error in columns:
+                value = {
+                    'timestamp': timestamp,
+                    'magnitude': magnitude,
+                    'filter': filter_name,
+                    'error': error
+                }
+                value.update(extras)
+                photometry.append(value)
+            yield photometry
 
+        if empty:
+            raise InvalidFileFormatException('Empty table or invalid file type')
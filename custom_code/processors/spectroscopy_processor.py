@@ -1,4 +1,6 @@
 import mimetypes
+from types import SimpleNamespace
+
 from tom_dataproducts.processors.spectroscopy_processor import SpectroscopyProcessor
 from tom_dataproducts.exceptions import InvalidFileFormatException
 from tom_dataproducts.processors.data_serializers import SpectrumSerializer
@@ -8,15 +10,23 @@ class SpecProcessor(SpectroscopyProcessor):
     FITS_MIMETYPES = ['image/fits', 'application/fits']
     PLAINTEXT_MIMETYPES = ['text/plain', 'text/csv']
     
-    def process_data(self, data_product, extras):
-    
-        mimetype = mimetypes.guess_type(data_product.data.path)[0]
-        if mimetype in self.FITS_MIMETYPES:
-            spectrum, obs_date = self._process_spectrum_from_fits(data_product)
-        elif mimetype in self.PLAINTEXT_MIMETYPES:
-            spectrum, obs_date = self._process_spectrum_from_plaintext(data_product)
+    def process_data(self, data_product, extras, fits_file=None):
+        """
+        Processes a spectroscopy DataProduct. If its FITS file is already in
+        memory, pass it as ``fits_file`` so that the file is not read again from disk.
+        """
+        if fits_file is not None:
+            # SpectroscopyProcessor only reads data_product.data.path, with fits.getdata,
+            # which also accepts a file object
+            spectrum, obs_date = self._process_spectrum_from_fits(SimpleNamespace(data=SimpleNamespace(path=fits_file)))
         else:
-            raise InvalidFileFormatException('Unsupported file type')
+            mimetype = mimetypes.guess_type(data_product.data.path)[0]
+            if mimetype in self.FITS_MIMETYPES:
+                spectrum, obs_date = self._process_spectrum_from_fits(data_product)
+            elif mimetype in self.PLAINTEXT_MIMETYPES:
+                spectrum, obs_date = self._process_spectrum_from_plaintext(data_product)
+            else:
+                raise InvalidFileFormatException('Unsupported file type')
 
         serialized_spectrum = SpectrumSerializer().serialize(spectrum)
 
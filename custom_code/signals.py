@@ -0,0 +1,62 @@
+import threading
+import time
+
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from tom_dataproducts.models import ReducedDatum
+from tom_targets.models import Target
+
+from custom_code.models import BinarySpectrum, SpectrumPreview
+from custom_code.photometry import update_photometry_summary, rebuild_photometry_summary
+
+# When this thread last started rebuilding the PhotometrySummary of each target
+_rebuilds = threading.local()
+
+
+def schedule_photometry_summary_rebuild(target_id):
+    """
+    Rebuilds the PhotometrySummary of a target once the current transaction
+    commits. Deleting many points in one transaction rebuilds it only once.
+    """
+    requested = time.monotonic()
+
+    def rebuild():
+        started = getattr(_rebuilds, 'started', None)
+        if started is None:
+            started = _rebuilds.started = {}
+        if started.get(target_id, -1) > requested:
+            return  # already rebuilt after this change was committed
+        started[target_id] = time.monotonic()
+        if Target.objects.filter(id=target_id).exists():
+            rebuild_photometry_summary(target_id)
+
+    transaction.on_commit(rebuild)
+
+
+@receiver(post_save, sender=ReducedDatum)
+def reduced_datum_post_save(sender, instance, created, raw=False, **kwargs):
+    """
+    Keeps the PhotometrySummary up to date when photometry is saved from
+    anywhere, e.g. the TOM views, the admin or the SNEx1 sync. ``bulk_create``
+    does not send this signal, so code that bulk creates photometry calls
+    ``update_photometry_summary`` itself. Also deletes the binary copy and the
+    preview of a spectrum whose value changed.
+    """
+    if raw:
+        return
+    if instance.data_type == 'spectroscopy' and not created:
+        BinarySpectrum.objects.filter(reduced_datum=instance).delete()
+        SpectrumPreview.objects.filter(reduced_datum=instance).delete()
+    if instance.data_type != 'photometry':
+        return
+    if created:
+        update_photometry_summary(instance.target_id, [instance])
+    else:
+        schedule_photometry_summary_rebuild(instance.target_id)
+
+
+@receiver(post_delete, sender=ReducedDatum)
+def reduced_datum_post_delete(sender, instance, **kwargs):
+    if instance.data_type == 'photometry':
+        schedule_photometry_summary_rebuild(instance.target_id)
@@ -0,0 +1,170 @@
+import numpy as np
+from django.conf import settings
+from tom_dataproducts.models import ReducedDatum
+from tom_dataproducts.processors.data_serializers import SpectrumSerializer
+from tom_dataproducts.processors.spectroscopy_processor import SpectroscopyProcessor
+
+from custom_code.models import BinarySpectrum, SpectrumPreview
+
+WAVELENGTH_UNITS = SpectroscopyProcessor.DEFAULT_WAVELENGTH_UNITS
+FLUX_UNITS = SpectroscopyProcessor.DEFAULT_FLUX_CONSTANT
+
+SPECTRUM_DTYPE = np.dtype('<f4')
+
+# Previews keep the minimum and maximum flux of this many bins
+SPECTRUM_PREVIEW_BINS = 200
+
+
+def spectrum_from_value(value):
+    """
+    Returns the wavelength and flux arrays of a spectrum stored in the JSON
+    ``value`` of a ReducedDatum, in the default units of SpectroscopyProcessor
+    """
+    if 'flux' in value:
+        datum = SpectrumSerializer().deserialize(value)
+        wavelength = datum.spectral_axis.to(WAVELENGTH_UNITS).value
+        flux = datum.new_flux_unit(FLUX_UNITS).flux.value
+    else:  # older spectra were stored as one dictionary per point
+        wavelength = np.array([float(point['wavelength']) for point in value.values()])
+        flux = np.array([float(point['flux']) for point in value.values()])
+    return wavelength, flux
+
+
+def spectrum_from_binary(binary_spectrum):
+    """
+    Returns the wavelength and flux arrays of a BinarySpectrum or SpectrumPreview
+    """
+    return np.frombuffer(binary_spectrum.data, dtype=SPECTRUM_DTYPE).reshape(2, -1)
+
+
+def get_spectrum(reduced_datum):
+    """
+    Returns the wavelength and flux arrays of a spectroscopy ReducedDatum, in
+    the default units of SpectroscopyProcessor, whichever way it is stored
+    """
+    if hasattr(reduced_datum, 'binaryspectrum'):
+        return spectrum_from_binary(reduced_datum.binaryspectrum)
+    return spectrum_from_value(reduced_datum.value)
+
+
+def get_spectra(reduced_datums):
+    """
+    Returns the wavelength and flux arrays of spectroscopy ReducedDatums. The
+    JSON values are only loaded, in one query, for the spectra without a
+    BinarySpectrum.
+
+    :returns: list of (reduced_datum, wavelength, flux) tuples
+    :rtype: list
+    """
+    reduced_datums = list(reduced_datums.select_related('binaryspectrum').defer('value'))
+    missing = [reduced_datum.id for reduced_datum in reduced_datums if not hasattr(reduced_datum, 'binaryspectrum')]
+    values = {}
+    if missing:
+        values = dict(ReducedDatum.objects.filter(id__in=missing).values_list('id', 'value'))
+
+    spectra = []
+    for reduced_datum in reduced_datums:
+        if reduced_datum.id in values:
+            wavelength, flux = spectrum_from_value(values[reduced_datum.id])
+        else:
+            wavelength, flux = spectrum_from_binary(reduced_datum.binaryspectrum)
+        spectra.append((reduced_datum, wavelength, flux))
+    return spectra
+
+
+def downsample_spectrum(wavelength, flux, bins=SPECTRUM_PREVIEW_BINS):
+    """
+    Downsamples a spectrum to at most ``2*bins`` points by keeping the points
+    with the minimum and maximum flux of each bin, so that lines and the
+    overall shape survive
+    """
+    finite = np.isfinite(wavelength) & np.isfinite(flux)
+    wavelength, flux = wavelength[finite], flux[finite]
+    if len(flux) <= 2 * bins:
+        return wavelength, flux
+
+    edges = np.linspace(0, len(flux), bins + 1).astype(int)
+    keep = []
+    for start, end in zip(edges[:-1], edges[1:]):
+        segment = flux[start:end]
+        keep.extend(sorted({start + int(np.argmin(segment)), start + int(np.argmax(segment))}))
+    return wavelength[keep], flux[keep]
+
+
+def build_preview(reduced_datum, wavelength, flux):
+    """
+    Returns an unsaved SpectrumPreview of a spectrum
+    """
+    wavelength, flux = downsample_spectrum(wavelength, flux)
+    return SpectrumPreview(reduced_datum=reduced_datum,
+                           data=np.array([wavelength, flux], dtype=SPECTRUM_DTYPE).tobytes())
+
+
+def get_spectrum_previews(reduced_datums):
+    """
+    Returns the downsampled wavelength and flux arrays of spectroscopy
+    ReducedDatums. The full spectra are only loaded, in one query, for the
+    ones without a saved preview, which are downsampled without being saved;
+    ``manage.py build_spectrum_previews`` saves them.
+
+    :returns: list of (reduced_datum, wavelength, flux) tuples
+    :rtype: list
+    """
+    reduced_datums = list(reduced_datums.select_related('spectrumpreview').defer('value'))
+    missing = [reduced_datum.id for reduced_datum in reduced_datums if not hasattr(reduced_datum, 'spectrumpreview')]
+    full_spectra = {}
+    if missing:
+        full_spectra = {
+            reduced_datum.id: reduced_datum
+            for reduced_datum in ReducedDatum.objects.filter(id__in=missing).select_related('binaryspectrum')
+        }
+
+    previews = []
+    for reduced_datum in reduced_datums:
+        if reduced_datum.id in full_spectra:
+            wavelength, flux = downsample_spectrum(*get_spectrum(full_spectra[reduced_datum.id]))
+        else:
+            wavelength, flux = spectrum_from_binary(reduced_datum.spectrumpreview)
+        previews.append((reduced_datum, wavelength, flux))
+    return previews
+
+
+def save_spectrum_previews(reduced_datums):
+    """
+    Saves the previews of the spectroscopy ReducedDatums that do not have one yet
+
+    :returns: the number of previews saved
+    :rtype: int
+    """
+    spectra = reduced_datums.filter(data_type='spectroscopy', spectrumpreview__isnull=True)
+    previews = SpectrumPreview.objects.bulk_create([
+        build_preview(reduced_datum, wavelength, flux) for reduced_datum, wavelength, flux in get_spectra(spectra)
+    ], ignore_conflicts=True)
+    return len(previews)
+
+
+def convert_to_binary(reduced_datum):
+    """
+    Saves a float32 copy of the wavelength and flux of a spectroscopy
+    ReducedDatum in a BinarySpectrum, which SNEx2 plots read instead of
+    parsing the JSON value. The value is left as it is, because TOM's views,
+    SpectrumSerializer and the REST API read it.
+    """
+    wavelength, flux = spectrum_from_value(reduced_datum.value)
+    BinarySpectrum.objects.update_or_create(
+        reduced_datum=reduced_datum,
+        defaults={'data': np.array([wavelength, flux], dtype=SPECTRUM_DTYPE).tobytes()}
+    )
+
+
+def store_spectra(reduced_datums):
+    """
+    Saves the previews of newly processed spectra, and their binary copies
+    if SPECTRUM_STORAGE is 'binary'
+    """
+    save_spectrum_previews(reduced_datums)
+
+    if settings.SPECTRUM_STORAGE != 'binary':
+        return
+    for reduced_datum in reduced_datums.filter(data_type='spectroscopy', binaryspectrum__isnull=True):
+        convert_to_binary(reduced_datum)
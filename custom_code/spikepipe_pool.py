@@ -0,0 +1,54 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+
+_executor = None
+_executor_lock = threading.Lock()
+
+# Values of the spikepipe photometry returned to the caller
+DATUM_KEYS = ('MJD', 'mag', 'dmag', 'filter', 'zp', 'dzp', 'telescope')
+
+
+def measure_frame(path, target_coords):
+    """
+    Runs spikepipe on a single e91 frame of a target. This is called in one of
+    the spikepipe processes, so it must not touch the database; the caller
+    saves the results. The PS1 catalog of the target is loaded once per process.
+
+    :returns: the photometry of the target in the frame
+    :rtype: dict
+    """
+    from spikepipe.spikepipe import preprocess_lco_image, extract_photometry
+    from custom_code.catalogs import get_ps1_catalog
+
+    catalog, catalog_coords, target = get_ps1_catalog(target_coords)
+    ccddata = preprocess_lco_image(path, catalog_coords)
+    catalog['catalog_mag'] = catalog[ccddata.meta['FILTER'][0] + 'MeanPSFMag']
+    datum = extract_photometry(ccddata, catalog, catalog_coords, target)
+    return {key: datum[key] for key in DATUM_KEYS}
+
+
+def get_spikepipe_executor():
+    """
+    Returns the process pool shared by every spikepipe run in this process,
+    with ``settings.SPIKEPIPE_PROCESSES`` processes, so that a night of frames
+    never decompresses and fits more than that many images at once
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=settings.SPIKEPIPE_PROCESSES,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return _executor
+
+
+def shutdown_spikepipe_executor():
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown()
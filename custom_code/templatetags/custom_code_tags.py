@@ -1,7 +1,8 @@
-from plotly import offline
 import plotly.graph_objs as go
 from django import template
 from django.utils.safestring import mark_safe
+from django.utils.html import format_html
+from django.templatetags.static import static
 from django.conf import settings
 from django.db.models.functions import Lower
 from django.shortcuts import reverse
@@ -10,40 +11,43 @@ from django.contrib.auth.models import User, Group
 
 from tom_targets.models import Target, TargetExtra
 from tom_targets.forms import TargetVisibilityForm
-from tom_observations import utils, facility
-from tom_dataproducts.models import DataProduct, ReducedDatum, ObservationRecord
-from tom_dataproducts.processors.data_serializers import SpectrumSerializer
+from tom_observations import utils
+from tom_dataproducts.models import ReducedDatum, ObservationRecord
 from tom_dataproducts.processors.spectroscopy_processor import SpectroscopyProcessor
 
-from astroplan import Observer, FixedTarget, AtNightConstraint, time_grid_from_range, moon_illumination
+from astroplan import AtNightConstraint, moon_illumination
 import datetime
 import json
 from astropy.time import Time
 from astropy import units as u
-from astropy.coordinates import get_moon, get_sun, SkyCoord, AltAz
+from astropy.coordinates import get_moon, SkyCoord, AltAz
 import numpy as np
 import time
 import re
 
-from custom_code.models import ScienceTags, TargetTags, ReducedDatumExtra, Papers
+from custom_code.models import ScienceTags, TargetTags, DataProductExtra, Papers, BackgroundJob
 from custom_code.forms import CustomDataProductUploadForm, PapersForm
+from custom_code.visibility import get_time_grid, get_visibility
+from custom_code.photometry import get_photometry, decimate_photometry
+from custom_code.spectra import get_spectra, get_spectrum_previews
+from custom_code.plotting import render_figure, PLOTLY_JS
+from custom_code.cache import get_or_set_target_plot
 from urllib.parse import urlencode
-from tom_observations.utils import get_sidereal_visibility
 from custom_code.facilities.lco import SnexPhotometricSequenceForm, SnexSpectroscopicSequenceForm
 register = template.Library()
 
 @register.inclusion_tag('custom_code/airmass_collapse.html')
-def airmass_collapse(target):
+def airmass_collapse(target, plot_data=None):
     interval = 30 #min
     airmass_limit = 3.0
 
-    obj = Target
-    obj.ra = target.ra
-    obj.dec = target.dec
-    obj.epoch = 2000
-    obj.type = 'SIDEREAL' 
-
-    plot_data = get_24hr_airmass(obj, interval, airmass_limit)
+    if plot_data is None:
+        plot_data = get_24hr_airmass(target, interval, airmass_limit)
+    if plot_data is None:
+        return {
+            'target': target,
+            'figure': 'No coordinates for this target.'
+        }
     layout = go.Layout(
         xaxis=dict(gridcolor='#D3D3D3',showline=True,linecolor='#D3D3D3',mirror=True),
         yaxis=dict(range=[airmass_limit,1.0],gridcolor='#D3D3D3',showline=True,linecolor='#D3D3D3',mirror=True),
@@ -54,20 +58,36 @@ def airmass_collapse(target):
         showlegend=False,
         plot_bgcolor='white'
     )
-    visibility_graph = offline.plot(
-            go.Figure(data=plot_data, layout=layout), output_type='div', show_link=False, config={'staticPlot': True}, include_plotlyjs='cdn'
-    )
+    visibility_graph = render_figure(go.Figure(data=plot_data, layout=layout), config={'staticPlot': True})
     return {
         'target': target,
         'figure': visibility_graph
     }
 
+
+def airmass_collapse_batch(targets):
+    """
+    Renders the airmass_collapse figure of every target in ``targets``,
+    computing the visibility of all of them in a single call.
+    """
+    interval = 30 #min
+    airmass_limit = 3.0
+
+    plot_data = get_24hr_airmass_for_targets(targets, interval, airmass_limit)
+    return {target.id: airmass_collapse(target, target_plot_data)['figure']
+            for target, target_plot_data in zip(targets, plot_data)}
+
 @register.inclusion_tag('custom_code/airmass.html', takes_context=True)
 def airmass_plot(context):
     #request = context['request']
     interval = 15 #min
     airmass_limit = 3.0
     plot_data = get_24hr_airmass(context['object'], interval, airmass_limit)
+    if plot_data is None:
+        return {
+            'target': context['object'],
+            'figure': 'No coordinates for this target.'
+        }
     layout = go.Layout(
         xaxis=dict(gridcolor='#D3D3D3',showline=True,linecolor='#D3D3D3',mirror=True),
         yaxis=dict(range=[airmass_limit,1.0],gridcolor='#D3D3D3',showline=True,linecolor='#D3D3D3',mirror=True),
@@ -77,42 +97,34 @@ def airmass_plot(context):
         height=300,
         plot_bgcolor='white'
     )
-    visibility_graph = offline.plot(
-        go.Figure(data=plot_data, layout=layout), output_type='div', show_link=False
-    )
+    visibility_graph = render_figure(go.Figure(data=plot_data, layout=layout))
     return {
         'target': context['object'],
         'figure': visibility_graph
     }
 
 def get_24hr_airmass(target, interval, airmass_limit):
+    return get_24hr_airmass_for_targets([target], interval, airmass_limit)[0]
 
-    plot_data = []
+
+def get_24hr_airmass_for_targets(targets, interval, airmass_limit):
+    """
+    Returns the list of airmass traces for each target in ``targets``, or
+    None for targets without coordinates. The visibility of every target at
+    every site is computed as a single (targets x sites x times) array.
+    """
+    has_coords = [target.ra is not None and target.dec is not None for target in targets]
+    targets = [target for target, located in zip(targets, has_coords) if located]
+    if not targets:
+        return [None] * len(has_coords)
     
-    start = Time(datetime.datetime.utcnow())
-    end = Time(start.datetime + datetime.timedelta(days=1))
-    time_range = time_grid_from_range(
-        time_range = [start, end],
-        time_resolution = interval*u.minute)
+    start = datetime.datetime.utcnow()
+    end = start + datetime.timedelta(days=1)
+    time_range = get_time_grid(start, end, interval)
     time_plot = time_range.datetime
     
-    fixed_target = FixedTarget(name = target.name, 
-        coord = SkyCoord(
-            target.ra,
-            target.dec,
-            unit = 'deg'
-        )
-    )
-
-    #Hack to speed calculation up by factor of ~3
-    sun_coords = get_sun(time_range[int(len(time_range)/2)])
-    fixed_sun = FixedTarget(name = 'sun',
-        coord = SkyCoord(
-            sun_coords.ra,
-            sun_coords.dec,
-            unit = 'deg'
-        )
-    )
+    coords = SkyCoord([target.ra for target in targets], [target.dec for target in targets], unit='deg')
+    sites, airmass = get_visibility(coords, time_range, airmass_limit)
 
     #Colors to match SNEx1
     colors = {
@@ -124,40 +136,23 @@ def get_24hr_airmass(target, interval, airmass_limit):
         'Haleakala': '#990099'
     }
 
-    for observing_facility in facility.get_service_classes():
+    all_plot_data = []
+    for target_airmass in airmass:
 
-        observing_facility_class = facility.get_service_class(observing_facility)
-        sites = observing_facility_class().get_observing_sites()
-
-        for site, site_details in sites.items():
-
-            observer = Observer(
-                longitude = site_details.get('longitude')*u.deg,
-                latitude = site_details.get('latitude')*u.deg,
-                elevation = site_details.get('elevation')*u.m
-            )
-            
-            sun_alt = observer.altaz(time_range, fixed_sun).alt
-            obj_airmass = observer.altaz(time_range, fixed_target).secz
-
-            bad_indices = np.argwhere(
-                (obj_airmass >= airmass_limit) |
-                (obj_airmass <= 1) |
-                (sun_alt > -18*u.deg)  #between astro twilights
-            )
-
-            obj_airmass = [np.nan if i in bad_indices else float(x)
-                for i, x in enumerate(obj_airmass)]
+        plot_data = []
+        for (observing_facility, site), obj_airmass in zip(sites, target_airmass):
 
             label = '({facility}) {site}'.format(
                 facility = observing_facility, site = site
             )
 
             plot_data.append(
-                go.Scatter(x=time_plot, y=obj_airmass, mode='lines', name=label, marker=dict(color=colors.get(site)))
+                go.Scatter(x=time_plot, y=obj_airmass.filled(np.nan), mode='lines', name=label, marker=dict(color=colors.get(site)))
             )
+        all_plot_data.append(plot_data)
 
-    return plot_data
+    all_plot_data = iter(all_plot_data)
+    return [next(all_plot_data) if located else None for located in has_coords]
 
 
 def get_color(filter_name):
@@ -186,8 +181,6 @@ def get_color(filter_name):
 @register.inclusion_tag('custom_code/lightcurve.html', takes_context=True)
 def lightcurve(context, target):
          
-    photometry_data = {}
-
     if settings.TARGET_PERMISSIONS_ONLY:
         datums = ReducedDatum.objects.filter(target=target, data_type=settings.DATA_PRODUCT_TYPES['photometry'][0])
     else:
@@ -197,16 +190,7 @@ def lightcurve(context, target):
                                         target=target,
                                         data_type=settings.DATA_PRODUCT_TYPES['photometry'][0]))
 
-    for rd in datums:
-    #for rd in ReducedDatum.objects.filter(target=target, data_type='photometry'):
-        value = rd.value
-        if not value:  # empty
-            continue
-   
-        photometry_data.setdefault(value.get('filter', ''), {})
-        photometry_data[value.get('filter', '')].setdefault('time', []).append(rd.timestamp)
-        photometry_data[value.get('filter', '')].setdefault('magnitude', []).append(value.get('magnitude',None))
-        photometry_data[value.get('filter', '')].setdefault('error', []).append(value.get('error', None))        
+    photometry_data = decimate_photometry(get_photometry(datums), settings.LIGHTCURVE_MAX_POINTS)
 
     plot_data = [
         go.Scatter(
@@ -235,7 +219,7 @@ def lightcurve(context, target):
     if plot_data:
       return {
           'target': target,
-          'plot': offline.plot(go.Figure(data=plot_data, layout=layout), output_type='div', show_link=False)
+          'plot': render_figure(go.Figure(data=plot_data, layout=layout))
       }
     else:
         return {
@@ -247,7 +231,6 @@ def lightcurve(context, target):
 @register.inclusion_tag('custom_code/lightcurve_collapse.html')
 def lightcurve_collapse(target, user):
          
-    photometry_data = {}
     if settings.TARGET_PERMISSIONS_ONLY:
         datums = ReducedDatum.objects.filter(target=target, data_type=settings.DATA_PRODUCT_TYPES['photometry'][0])
     else:
@@ -256,13 +239,7 @@ def lightcurve_collapse(target, user):
                                       klass=ReducedDatum.objects.filter(
                                         target=target,
                                         data_type=settings.DATA_PRODUCT_TYPES['photometry'][0]))
-    #for rd in ReducedDatum.objects.filter(target=target, data_type='photometry'): 
-    for rd in datums:
-        value = rd.value
-        photometry_data.setdefault(value.get('filter', ''), {})
-        photometry_data[value.get('filter', '')].setdefault('time', []).append(rd.timestamp)
-        photometry_data[value.get('filter', '')].setdefault('magnitude', []).append(value.get('magnitude',None))
-        photometry_data[value.get('filter', '')].setdefault('error', []).append(value.get('error', None))
+    photometry_data = decimate_photometry(get_photometry(datums), settings.LIGHTCURVE_COLLAPSE_MAX_POINTS)
     plot_data = [
         go.Scatter(
             x=filter_values['time'],
@@ -288,7 +265,7 @@ def lightcurve_collapse(target, user):
     if plot_data:
         return {
             'target': target,
-            'plot': offline.plot(go.Figure(data=plot_data, layout=layout), output_type='div', show_link=False, config={'staticPlot': True}, include_plotlyjs='cdn')
+            'plot': render_figure(go.Figure(data=plot_data, layout=layout), config={'staticPlot': True})
         }
     else:
         return {
@@ -337,24 +314,28 @@ def moon_vis(target):
         height=300,
         plot_bgcolor='white'
     )
-    figure = offline.plot(
-        go.Figure(data=plot_data, layout=layout), output_type='div', show_link=False
-    )
+    figure = render_figure(go.Figure(data=plot_data, layout=layout))
    
     return {'plot': figure}
 
-@register.inclusion_tag('custom_code/spectra.html')
-def spectra_plot(target, dataproduct=None):
+def get_spectra_plot_data(target, dataproduct=None):
+    """
+    Returns the (wavelength, flux, name) of each spectrum of a target, or
+    of one of its data products, newest first
+    """
     spectra = []
     spectral_dataproducts = ReducedDatum.objects.filter(target=target, data_type='spectroscopy').order_by('-timestamp')
     if dataproduct:
-        spectral_dataproducts = DataProduct.objects.get(dataproduct=dataproduct)
-    for spectrum in spectral_dataproducts:
-        datum = SpectrumSerializer().deserialize(spectrum.value)
-        wavelength = datum.spectral_axis.to(SpectroscopyProcessor.DEFAULT_WAVELENGTH_UNITS).value
-        flux = datum.new_flux_unit(SpectroscopyProcessor.DEFAULT_FLUX_CONSTANT).flux.value
+        spectral_dataproducts = spectral_dataproducts.filter(data_product=dataproduct)
+    for spectrum, wavelength, flux in get_spectra(spectral_dataproducts):
         name = str(spectrum.timestamp).split(' ')[0]
         spectra.append((wavelength, flux, name))
+    return spectra
+
+
+@register.inclusion_tag('custom_code/spectra.html')
+def spectra_plot(target, dataproduct=None):
+    spectra = get_spectra_plot_data(target, dataproduct)
     wavelength_unit = SpectroscopyProcessor.DEFAULT_WAVELENGTH_UNITS.to_string('unicode')
     flux_unit = re.sub('\s*─+\s*', ' / ', SpectroscopyProcessor.DEFAULT_FLUX_CONSTANT.to_string('unicode').strip())
     plot_data = [
@@ -388,7 +369,7 @@ def spectra_plot(target, dataproduct=None):
     if plot_data:
       return {
           'target': target,
-          'plot': offline.plot(go.Figure(data=plot_data, layout=layout), output_type='div', show_link=False)
+          'plot': render_figure(go.Figure(data=plot_data, layout=layout))
       }
     else:
         return {
@@ -400,7 +381,7 @@ def spectra_plot(target, dataproduct=None):
 def spectra_collapse(target):
     spectral_dataproducts = ReducedDatum.objects.filter(target=target, data_type='spectroscopy').order_by('-timestamp')
     plot_data = [
-        go.Scatter(x=spectrum.value['wavelength'], y=spectrum.value['flux']) for spectrum in spectral_dataproducts
+        go.Scatter(x=wavelength, y=flux) for _, wavelength, flux in get_spectrum_previews(spectral_dataproducts)
     ]
     layout = go.Layout(
         height=200,
@@ -425,7 +406,7 @@ def spectra_collapse(target):
     if plot_data:
         return {
             'target': target,
-            'plot': offline.plot(go.Figure(data=plot_data, layout=layout), output_type='div', show_link=False, config={'staticPlot': True}, include_plotlyjs='cdn')
+            'plot': render_figure(go.Figure(data=plot_data, layout=layout), config={'staticPlot': True})
         }
     else:
         return {
@@ -442,6 +423,18 @@ def get_fleet_plot(target):
     data_product = target.dataproduct_set.filter(product_id=target.name+'_FLEET').last()
     return {'fleet_plot': data_product, 'target': target}
 
+@register.inclusion_tag('custom_code/background_jobs.html')
+def background_jobs(target, limit=10):
+    jobs = BackgroundJob.objects.filter(target=target).select_related('data_product').order_by('-id')[:limit]
+    return {'jobs': jobs}
+
+@register.simple_tag
+def plotly_js():
+    """
+    Loads plotly.js for the figures of the page, which do not include it
+    """
+    return format_html('<script src="{}"></script>', static(PLOTLY_JS))
+
 @register.filter
 def photometry(target):
     return target.reduceddatum_set.filter(data_type='photometry')
@@ -464,6 +457,18 @@ def magerrformat(reduceddatum, digits='1'):
     else:
         return ''
 
+@register.filter
+def summarymagformat(summary, point, digits='1'):
+    """
+    Formats the 'first', 'latest' or 'peak' magnitude of a PhotometrySummary
+    like ``magformat``
+    """
+    magnitude = getattr(summary, f'{point}_magnitude', None)
+    if magnitude is None:
+        return ''
+    magstr = '{{magnitude:.{digits}f}}'.format(digits=digits)
+    return format_html('{}&nbsp;=&nbsp;{}', getattr(summary, f'{point}_filter'), magstr.format(magnitude=magnitude))
+
 @register.filter
 def brightest(phot):
     if phot:
@@ -557,46 +562,49 @@ def submit_lco_observations(target):
             'phot_form': phot_form,
             'spec_form': spec_form}
 
+def get_dash_lightcurve_options(target):
+    """
+    Returns the choices and initial values of the Dash lightcurve of a
+    target, which do not depend on the size of the plot. This takes a few
+    queries however much photometry the target has.
+    """
+    photometry = ReducedDatum.objects.filter(target=target, data_type='photometry')
+    background_subtracted = photometry.filter(value__background_subtracted=True).exists()
+
+    upload_extras = DataProductExtra.objects.filter(target=target, data_type='photometry')
+    choices = list(upload_extras.values_list('instrument', 'used_in', 'reducer_group').order_by().distinct())
+    telescopes = sorted({instrument for instrument, _, _ in choices if instrument})
+    papers_used_in = sorted({used_in for _, used_in, _ in choices if used_in})
+    reducer_groups = sorted({reducer_group for _, _, reducer_group in choices if reducer_group})
+
+    final_reductions = upload_extras.filter(final_reduction=True).values('data_product_id')
+    final_reduction = final_reductions.exists()
+    final_background_subtracted = final_reduction and photometry.filter(
+        data_product_id__in=final_reductions, value__background_subtracted=True).exists()
+
+    return {
+        'final_reduction': final_reduction,
+        'background_subtracted': background_subtracted,
+        'final_background_subtracted': final_background_subtracted,
+        'telescopes': telescopes,
+        'papers_used_in': papers_used_in,
+        'reducer_groups': reducer_groups
+    }
+
+
 @register.inclusion_tag('custom_code/dash_lightcurve.html', takes_context=True)
 def dash_lightcurve(context, target, width, height):
     request = context['request']
     
     # Get initial choices and values for some dash elements
-    telescopes = []
-    reducer_groups = []
-    papers_used_in = []
-    final_reduction = False
-    background_subtracted = False
-
-    datumquery = ReducedDatum.objects.filter(target=target, data_type='photometry')
-    for i in datumquery:
-        datum_value = i.value
-        if datum_value.get('background_subtracted', '') == True:
-            background_subtracted = True
-            break
-
-    final_background_subtracted = False
-    for de in ReducedDatumExtra.objects.filter(target=target, key='upload_extras', data_type='photometry'):
-        de_value = de.value
-        inst = de_value.get('instrument', '')
-        used_in = de_value.get('used_in', '')
-        group = de_value.get('reducer_group', '')
-
-        if inst and inst not in telescopes:
-            telescopes.append(inst)
-        if used_in and used_in not in papers_used_in:
-            papers_used_in.append(used_in)
-        if group and group not in reducer_groups:
-            reducer_groups.append(group)
-   
-        if de_value.get('final_reduction', '')==True:
-            final_reduction = True
-            final_reduction_datumid = de_value.get('data_product_id', '')
-
-            datum = ReducedDatum.objects.filter(target=target, data_type='photometry', data_product_id=final_reduction_datumid)
-            datum_value = datum.first().value
-            if datum_value.get('background_subtracted', '') == True:
-                final_background_subtracted = True
+    options = get_or_set_target_plot('dash_lightcurve_options', target.id,
+                                     lambda: get_dash_lightcurve_options(target))
+    final_reduction = options['final_reduction']
+    background_subtracted = options['background_subtracted']
+    final_background_subtracted = options['final_background_subtracted']
+    telescopes = list(options['telescopes'])
+    papers_used_in = options['papers_used_in']
+    reducer_groups = list(options['reducer_groups'])
     
     reducer_group_options = []
     reducer_group_options.extend([{'label': k, 'value': k} for k in reducer_groups])
@@ -660,15 +668,17 @@ def custom_observation_plan(target, facility, length=1, interval=30, airmass_lim
     """
 
     visibility_graph = ''
-    start_time = datetime.datetime.now()
+    start_time = datetime.datetime.utcnow()
     end_time = start_time + datetime.timedelta(days=length)
 
-    visibility_data = get_sidereal_visibility(target, start_time, end_time, interval, airmass_limit)
-    i = 0
     plot_data = []
-    for site, data in visibility_data.items():
-        plot_data.append(go.Scatter(x=data[0], y=data[1], mode='markers+lines', marker={'symbol': i}, name=site))
-        i += 1
+    if target.type == 'SIDEREAL':
+        time_range = get_time_grid(start_time, end_time, interval)
+        coords = SkyCoord(target.ra, target.dec, unit='deg')
+        sites, airmass = get_visibility(coords, time_range, airmass_limit)
+        for i, ((observing_facility, site), obj_airmass) in enumerate(zip(sites, airmass)):
+            label = '({facility}) {site}'.format(facility=observing_facility, site=site)
+            plot_data.append(go.Scatter(x=time_range.datetime, y=obj_airmass.filled(np.nan), mode='markers+lines', marker={'symbol': i}, name=label))
     layout = go.Layout(
         xaxis=dict(gridcolor='#D3D3D3',showline=True,linecolor='#D3D3D3',mirror=True,title='Date'),
         yaxis=dict(range=[airmass_limit,1.0],gridcolor='#D3D3D3',showline=True,linecolor='#D3D3D3',mirror=True,title='Airmass'),
@@ -676,9 +686,7 @@ def custom_observation_plan(target, facility, length=1, interval=30, airmass_lim
         #yaxis={'autorange': 'reversed', 'title': 'Airmass'},
         plot_bgcolor='white'
     )
-    visibility_graph = offline.plot(
-        go.Figure(data=plot_data, layout=layout), output_type='div', show_link=False
-    )
+    visibility_graph = render_figure(go.Figure(data=plot_data, layout=layout))
 
     return {
         'visibility_graph': visibility_graph
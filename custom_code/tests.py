@@ -1,3 +1,365 @@
-from django.test import TestCase
+import io
+from datetime import datetime, timedelta
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from tom_targets.models import Target
+from tom_dataproducts.models import DataProduct, ReducedDatum
+from custom_code.models import ReducedDatumExtra, PhotometrySummary, BackgroundJob, BinarySpectrum, \
+    SpectrumPreview
+from custom_code import jobs
+from custom_code.dash_apps.lightcurve import update_graph
+from custom_code.processors.photometry_processor import PhotometryProcessor
+from custom_code.photometry import _snapshot_cache, bulk_create_photometry, rebuild_photometry_summary, \
+    get_photometry_columns, lttb_indices, decimate_photometry
+from custom_code.spectra import convert_to_binary, get_spectra, get_spectrum_previews, save_spectrum_previews, \
+    SPECTRUM_PREVIEW_BINS
+
+
+@override_settings(HOOKS={})
+class TestDashLightcurve(TestCase):
+    def setUp(self):
+        _snapshot_cache.clear()
+        self.target = Target.objects.create(name='2021abc', type='SIDEREAL', ra=10.0, dec=-20.0)
+        for i in range(10):
+            dp = DataProduct.objects.create(target=self.target, product_id=f'phot_{i}',
+                                            data_product_type='photometry')
+            ReducedDatum.objects.create(target=self.target, data_product=dp, data_type='photometry',
+                                        timestamp=timezone.now(),
+                                        value={'filter': 'g', 'magnitude': 18.0 + i/10., 'error': 0.1})
+            ReducedDatumExtra.objects.create(target=self.target, data_type='photometry', key='upload_extras',
+                                             value={'data_product_id': dp.id, 'instrument': 'LCO',
+                                                    'photometry_type': 'PSF'})
+        ReducedDatum.objects.create(target=self.target, data_type='photometry', timestamp=timezone.now(),
+                                    value={'filter': 'r', 'magnitude': 19.0, 'error': 0.2})
+
+    def get_graph(self, telescopes):
+        return update_graph(telescopes, 'Unsubtracted', ['Hotpants', 'PyZOGY'], ['LCO', 'SDSS'],
+                            ['PSF', 'Aperture'], ['', 'manual'], '', None, [''], self.target.id, 600, 360)
+
+    def test_update_graph_query_count(self):
+        with self.assertNumQueries(4):
+            graph = self.get_graph(['LCO'])
+        points = {trace.name: len(trace.x) for trace in graph['data']}
+        self.assertEqual(points, {'g': 10, 'r': 1})
+
+    def test_update_graph_reuses_snapshot(self):
+        self.get_graph(['LCO'])
+        with self.assertNumQueries(2):
+            graph = self.get_graph([])
+        self.assertEqual(sum(len(trace.x) for trace in graph['data']), 11)
+
+    def test_update_graph_refreshes_snapshot(self):
+        self.get_graph(['LCO'])
+        ReducedDatum.objects.create(target=self.target, data_type='photometry', timestamp=timezone.now(),
+                                    value={'filter': 'r', 'magnitude': 19.5, 'error': 0.2})
+        graph = self.get_graph(['LCO'])
+        points = {trace.name: len(trace.x) for trace in graph['data']}
+        self.assertEqual(points, {'g': 10, 'r': 2})
+
+    def test_update_graph_no_matching_data(self):
+        graph = self.get_graph(['Swift'])
+        self.assertEqual(graph, 'No photometry yet')
+
+
+@override_settings(HOOKS={})
+class TestPhotometryColumns(TestCase):
+    def test_non_numeric_values(self):
+        target = Target.objects.create(name='2021abc', type='SIDEREAL', ra=10.0, dec=-20.0)
+        for magnitude in (18.5, '19.0', '', '>19.5', None):
+            ReducedDatum.objects.create(target=target, data_type='photometry', timestamp=timezone.now(),
+                                        value={'filter': 'g', 'magnitude': magnitude, 'error': 0.1})
+        columns = get_photometry_columns(ReducedDatum.objects.filter(target=target).order_by('id'))
+        self.assertEqual(columns['magnitude'][:2].tolist(), [18.5, 19.0])
+        self.assertTrue(all(m != m for m in columns['magnitude'][2:]))
+        self.assertEqual(columns['error'].tolist(), [0.1] * 5)
+
+
+SUMMARY_FIELDS = ('count', 'filter_counts', 'first_timestamp', 'first_magnitude', 'first_filter',
+                  'latest_timestamp', 'latest_magnitude', 'latest_filter', 'peak_timestamp', 'peak_magnitude',
+                  'peak_filter', 'first_detection', 'last_detection', 'has_subtracted')
+
+
+def summary_fields(summary):
+    return {field: getattr(summary, field) for field in SUMMARY_FIELDS}
+
+
+@override_settings(HOOKS={})
+class TestPhotometrySummary(TestCase):
+    def setUp(self):
+        self.target = Target.objects.create(name='2021abc', type='SIDEREAL', ra=10.0, dec=-20.0)
+        self.start = datetime(2021, 5, 1, tzinfo=timezone.utc)
+
+    def photometry(self, days, value):
+        return ReducedDatum(target=self.target, data_type='photometry',
+                            timestamp=self.start + timedelta(days=days), value=value)
+
+    def test_add_point(self):
+        summary = PhotometrySummary(target=self.target)
+        summary.add_point(self.start + timedelta(days=2), {'filter': 'g', 'magnitude': 18.5})
+        summary.add_point(self.start + timedelta(days=1), {'filter': 'r', 'magnitude': 19.0})
+        summary.add_point(self.start + timedelta(days=3), {'filter': 'r', 'magnitude': '',
+                                                           'background_subtracted': True})
+
+        self.assertEqual(summary.count, 3)
+        self.assertEqual(summary.filter_counts, {'g': 1, 'r': 2})
+        self.assertTrue(summary.has_subtracted)
+        self.assertEqual((summary.first_timestamp, summary.first_filter), (self.start + timedelta(days=1), 'r'))
+        self.assertEqual((summary.latest_timestamp, summary.latest_magnitude), (self.start + timedelta(days=2), 18.5))
+        self.assertEqual((summary.peak_magnitude, summary.peak_filter), (18.5, 'g'))
+
+    def test_upper_limits(self):
+        summary = PhotometrySummary(target=self.target)
+        summary.add_point(self.start, {'filter': 'g', 'magnitude': 20.0, 'upperlimit': True})
+        self.assertIsNone(summary.peak_magnitude)
+        self.assertIsNone(summary.first_detection)
+
+        summary.add_point(self.start + timedelta(days=1), {'filter': 'g', 'magnitude': 19.0})
+        summary.add_point(self.start + timedelta(days=2), {'filter': 'g', 'magnitude': 17.0, 'upperlimit': 'True'})
+        self.assertEqual(summary.peak_magnitude, 19.0)
+        self.assertEqual(summary.first_detection, self.start + timedelta(days=1))
+        self.assertEqual(summary.last_detection, self.start + timedelta(days=1))
+        self.assertEqual(summary.latest_magnitude, 17.0)
+
+    def test_incremental_matches_rebuild(self):
+        self.photometry(5, {'filter': 'g', 'magnitude': 18.2, 'error': 0.1}).save()
+        bulk_create_photometry(self.target, [
+            self.photometry(1, {'filter': 'g', 'magnitude': 20.5, 'upperlimit': True}),
+            self.photometry(3, {'filter': 'r', 'magnitude': 17.9, 'error': 0.1}),
+            self.photometry(8, {'filter': 'r', 'magnitude': 18.4, 'error': 0.1, 'background_subtracted': True}),
+        ])
+        self.photometry(9, {'filter': 'V', 'magnitude': 18.8, 'error': 0.2}).save()
+
+        incremental = summary_fields(PhotometrySummary.objects.get(target=self.target))
+        self.assertEqual(incremental['count'], 5)
+        self.assertEqual(incremental['peak_magnitude'], 17.9)
+        self.assertEqual(incremental, summary_fields(rebuild_photometry_summary(self.target.id)))
+
+
+@override_settings(HOOKS={})
+class TestPhotometrySummaryDelete(TransactionTestCase):
+    def test_delete_rebuilds_summary(self):
+        target = Target.objects.create(name='2021abc', type='SIDEREAL', ra=10.0, dec=-20.0)
+        start = datetime(2021, 5, 1, tzinfo=timezone.utc)
+        peak = ReducedDatum.objects.create(target=target, data_type='photometry', timestamp=start,
+                                           value={'filter': 'g', 'magnitude': 17.0})
+        ReducedDatum.objects.create(target=target, data_type='photometry', timestamp=start + timedelta(days=1),
+                                    value={'filter': 'g', 'magnitude': 18.0})
+        self.assertEqual(PhotometrySummary.objects.get(target=target).peak_magnitude, 17.0)
+
+        ReducedDatum.objects.filter(id=peak.id).delete()
+        summary = PhotometrySummary.objects.get(target=target)
+        self.assertEqual((summary.count, summary.peak_magnitude), (1, 18.0))
+
+        target.delete()
+        self.assertFalse(PhotometrySummary.objects.exists())
+
+
+@override_settings(HOOKS={})
+class TestBulkCreatePhotometry(TestCase):
+    def setUp(self):
+        self.target = Target.objects.create(name='2021abc', type='SIDEREAL', ra=10.0, dec=-20.0)
+        self.start = datetime(2021, 5, 1, tzinfo=timezone.utc)
+
+    def photometry(self, days, value, source_name=''):
+        return ReducedDatum(target=self.target, data_type='photometry', source_name=source_name,
+                            timestamp=self.start + timedelta(days=days), value=value)
+
+    def test_duplicates_are_skipped(self):
+        value = {'filter': 'g', 'magnitude': 18.2, 'error': 0.1}
+        bulk_create_photometry(self.target, [self.photometry(1, value)])
+        created = bulk_create_photometry(self.target, [
+            self.photometry(1, dict(value)),
+            self.photometry(1, value),
+            self.photometry(2, value),
+            self.photometry(1, value, source_name='ZTF'),
+        ])
+        self.assertEqual(len(created), 2)
+        self.assertEqual(ReducedDatum.objects.filter(target=self.target).count(), 3)
+        self.assertEqual(PhotometrySummary.objects.get(target=self.target).count, 3)
+
+
+class TestLightcurveDecimation(SimpleTestCase):
+    def test_lttb_keeps_ends_and_peak(self):
+        x = np.arange(1000, dtype=float)
+        y = np.full(1000, 19.)
+        y[437] = 15.
+        indices = lttb_indices(x, y, 50)
+        self.assertEqual(len(indices), 50)
+        self.assertEqual((indices[0], indices[-1]), (0, 999))
+        self.assertIn(437, indices)
+        self.assertTrue(np.all(np.diff(indices) > 0))
+
+    def test_lttb_short_input(self):
+        self.assertEqual(lttb_indices(np.arange(10.), np.arange(10.), 50).tolist(), list(range(10)))
+
+    def get_photometry(self, upperlimit):
+        n = len(upperlimit)
+        start = datetime(2021, 5, 1, tzinfo=timezone.utc)
+        return {'g': {
+            'time': np.array([start + timedelta(hours=i) for i in range(n)], dtype=object),
+            'magnitude': 18. + np.sin(np.arange(n) / 200.),
+            'error': np.arange(n) / 1e4,
+            'upperlimit': upperlimit
+        }}
+
+    def test_decimate_keeps_upper_limits(self):
+        upperlimit = np.zeros(5000, dtype=bool)
+        upperlimit[::500] = True
+        photometry = self.get_photometry(upperlimit)
+        decimated = decimate_photometry(photometry, 300)['g']
+        self.assertLessEqual(len(decimated['magnitude']), 300)
+        self.assertEqual(decimated['upperlimit'].sum(), 10)
+        kept = np.rint(decimated['error'] * 1e4).astype(int)
+        np.testing.assert_array_equal(decimated['magnitude'], photometry['g']['magnitude'][kept])
+        self.assertEqual(list(decimated['time']), sorted(decimated['time']))
+        self.assertIs(decimate_photometry(photometry, 0), photometry)
+
+    def test_decimate_mostly_upper_limits(self):
+        upperlimit = np.ones(5000, dtype=bool)
+        upperlimit[::25] = False  # 200 detections
+        decimated = decimate_photometry(self.get_photometry(upperlimit), 300)['g']
+        self.assertEqual(len(decimated['magnitude']), 300)
+        self.assertEqual(decimated['upperlimit'].sum(), 150)
+        self.assertEqual(list(decimated['time']), sorted(decimated['time']))
+
+        upperlimit[:] = True
+        decimated = decimate_photometry(self.get_photometry(upperlimit), 300)['g']
+        self.assertEqual(len(decimated['magnitude']), 300)
+
+
+
+@mock.patch.object(PhotometryProcessor, 'CHUNK_SIZE', 1000)
+@mock.patch.object(PhotometryProcessor, 'CHUNKED_FILE_SIZE', 0)
+class TestPhotometryProcessor(SimpleTestCase):
+    def setUp(self):
+        self.rows = [(59000. + i / 10., 'gr'[i % 2], 18. + i / 1000., 0.1) for i in range(500)]
+
+    def read(self, text):
+        data_product = mock.Mock()
+        data_product.data.name = 'photometry.txt'
+        with mock.patch('custom_code.processors.photometry_processor.default_storage') as storage:
+            storage.open.return_value = io.StringIO(text)
+            storage.size.return_value = len(text)
+            chunks = list(PhotometryProcessor()._process_photometry_from_plaintext(data_product, {}))
+        self.assertGreater(len(chunks), 1)
+        photometry = [datum for chunk in chunks for datum in chunk]
+        self.assertEqual([(datum['filter'], datum['magnitude']) for datum in photometry],
+                         [(filter_name, magnitude) for _, filter_name, magnitude, _ in self.rows])
+        self.assertEqual(photometry[-1]['timestamp'], datetime(2020, 7, 19, 21, 36, tzinfo=timezone.utc))
+
+    def format_rows(self, delimiter):
+        return ''.join(delimiter.join(str(column) for column in row) + '\n' for row in self.rows)
+
+    def test_large_file(self):
+        self.read(self.format_rows(' '))
+
+    def test_large_csv(self):
+        self.read('time,filter,magnitude,error\n' + self.format_rows(','))
+
+    def test_large_headed_file(self):
+        self.read('MJD filt mag dmag\n' + self.format_rows(' '))
+
+
+@override_settings(HOOKS={})
+class TestSpectrumStorage(TestCase):
+    def setUp(self):
+        target = Target.objects.create(name='2021abc', type='SIDEREAL', ra=10.0, dec=-20.0)
+        self.wavelength = np.linspace(3500., 9000., 2000)
+        self.flux = 1e-15 * (1 + np.exp(-(self.wavelength - 6563.) ** 2 / 50.))
+        value = {str(i): {'wavelength': w, 'flux': f} for i, (w, f) in enumerate(zip(self.wavelength, self.flux))}
+        self.spectrum = ReducedDatum.objects.create(target=target, data_type='spectroscopy',
+                                                    timestamp=timezone.now(), value=value)
+
+    def test_binary_round_trip(self):
+        convert_to_binary(self.spectrum)
+        spectrum = ReducedDatum.objects.get(id=self.spectrum.id)
+        self.assertEqual(spectrum.value, self.spectrum.value)
+        with self.assertNumQueries(1):
+            (_, wavelength, flux), = get_spectra(ReducedDatum.objects.filter(id=self.spectrum.id))
+        np.testing.assert_allclose(wavelength, self.wavelength, rtol=1e-6)
+        np.testing.assert_allclose(flux, self.flux, rtol=1e-6)
+
+        spectrum.save()
+        self.assertFalse(BinarySpectrum.objects.filter(reduced_datum=spectrum).exists())
+
+    def test_previews(self):
+        spectra = ReducedDatum.objects.filter(id=self.spectrum.id)
+        (_, wavelength, flux), = get_spectrum_previews(spectra)
+        self.assertLessEqual(len(flux), 2 * SPECTRUM_PREVIEW_BINS)
+        self.assertAlmostEqual(flux.max(), self.flux.max(), delta=1e-21)
+        self.assertAlmostEqual(flux.min(), self.flux.min(), delta=1e-21)
+        self.assertEqual(list(wavelength), sorted(wavelength))
+        self.assertFalse(SpectrumPreview.objects.exists())
+
+        self.assertEqual(save_spectrum_previews(spectra), 1)
+        with self.assertNumQueries(1):
+            (_, saved_wavelength, saved_flux), = get_spectrum_previews(spectra)
+        np.testing.assert_allclose(saved_flux, flux, rtol=1e-6)
+
+
+def record_job(target, fail=False):
+    if fail:
+        raise ValueError('failed')
+
+
+@override_settings(HOOKS={})
+@mock.patch.dict(jobs.JOB_TASKS, {'test': 'custom_code.tests.record_job'})
+class TestJobQueue(TestCase):
+    def setUp(self):
+        self.target = Target.objects.create(name='2021abc', type='SIDEREAL', ra=10.0, dec=-20.0)
+
+    def test_enqueue_dedupes_active_jobs(self):
+        job = jobs.enqueue_job('test', self.target)
+        self.assertEqual(jobs.enqueue_job('test', self.target), job)
+        jobs.run_job(jobs.claim_job('worker'))
+        self.assertNotEqual(jobs.enqueue_job('test', self.target), job)
+
+    def test_claim_and_run(self):
+        job = jobs.enqueue_job('test', self.target)
+        claimed = jobs.claim_job('worker')
+        self.assertEqual((claimed.id, claimed.status, claimed.worker, claimed.attempts), (job.id, 'running', 'worker', 1))
+        self.assertIsNone(jobs.claim_job('worker'))
+        jobs.run_job(claimed)
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'finished')
+
+    def test_failed_jobs_are_retried(self):
+        job = jobs.enqueue_job('test', self.target, fail=True)
+        jobs.run_job(jobs.claim_job('worker'))
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'queued')
+        self.assertGreater(job.run_after, timezone.now())
+        self.assertIn('ValueError', job.error)
+
+        BackgroundJob.objects.filter(id=job.id).update(run_after=timezone.now(), max_attempts=2)
+        jobs.run_job(jobs.claim_job('worker'))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('failed', 2))
+
+    def test_requeue_stale_jobs(self):
+        stale = jobs.enqueue_job('test', self.target, dedupe_key='stale')
+        alive = jobs.enqueue_job('test', self.target, dedupe_key='alive')
+        jobs.claim_job('dead')
+        jobs.claim_job('alive')
+        BackgroundJob.objects.filter(id=stale.id).update(heartbeat=timezone.now() - 2 * jobs.JOB_STALE_TIMEOUT)
+        self.assertEqual(jobs.requeue_stale_jobs(), (1, 0))
+        self.assertEqual(BackgroundJob.objects.get(id=stale.id).status, 'queued')
+        self.assertEqual(BackgroundJob.objects.get(id=alive.id).status, 'running')
+
+        # a worker restarting with the same name requeues its own jobs
+        self.assertEqual(jobs.requeue_stale_jobs('alive'), (1, 0))
+
+    def test_spikepipe_batches_are_merged(self):
+        first = jobs.enqueue_spikepipe_batch(self.target, [3, 1])
+        self.assertEqual(jobs.enqueue_spikepipe_batch(self.target, [1, 2]), first)
+        first.refresh_from_db()
+        self.assertEqual(first.kwargs['data_product_ids'], [1, 2, 3])
+
+        jobs.claim_job('worker')
+        follow_up = jobs.enqueue_spikepipe_batch(self.target, [4])
+        self.assertNotEqual(follow_up, first)
+        self.assertEqual(jobs.enqueue_spikepipe_batch(self.target, [5]), follow_up)
@@ -1,6 +1,7 @@
 from django.urls import path
 
-from custom_code.views import TargetListView, PaperCreateView, RunFleetView
+from custom_code.views import TargetListView, PaperCreateView, RunFleetView, AirmassPanelView, LightcurvePanelView, \
+    SpectraPanelView, ObservationsPanelView
 
 app_name = 'custom_code'
 
@@ -8,4 +9,8 @@ urlpatterns = [
     path('targets/', TargetListView.as_view(), name='targets'),
     path('create-paper/', PaperCreateView.as_view(), name='create-paper'),
     path('run-fleet/<int:pk>/', RunFleetView.as_view(), name='run-fleet'),
+    path('targets/<int:pk>/airmass/', AirmassPanelView.as_view(), name='airmass-panel'),
+    path('targets/<int:pk>/lightcurve/', LightcurvePanelView.as_view(), name='lightcurve-panel'),
+    path('targets/<int:pk>/spectra/', SpectraPanelView.as_view(), name='spectra-panel'),
+    path('targets/<int:pk>/observations/', ObservationsPanelView.as_view(), name='observations-panel'),
 ]
@@ -1,9 +1,11 @@
 from django_filters.views import FilterView
 from django.shortcuts import redirect, render
+from django.db import transaction
 from django.db.models import Q #
-from django.http import HttpResponse, JsonResponse, HttpResponseRedirect
+from django.http import HttpResponse, JsonResponse, HttpResponseRedirect, HttpResponseBadRequest
 from django.views.generic.edit import FormView, UpdateView
 from django.urls import reverse
+from django.template.loader import render_to_string
 
 from tom_targets.views import TargetListView, TargetDetailView
 from custom_code.models import ScienceTags, TargetTags, ReducedDatumExtra, Papers
@@ -31,7 +33,7 @@ from plotly import offline
 import plotly.graph_objs as go
 from tom_dataproducts.models import ReducedDatum
 from django.utils.safestring import mark_safe
-from custom_code.templatetags.custom_code_tags import get_24hr_airmass, airmass_collapse, lightcurve_collapse, spectra_collapse
+from custom_code.templatetags.custom_code_tags import get_24hr_airmass, airmass_collapse_batch, lightcurve_collapse, spectra_collapse
 
 from .forms import CustomTargetCreateForm, CustomDataProductUploadForm, PapersForm
 from tom_targets.views import TargetCreateView
@@ -40,8 +42,8 @@ from tom_dataproducts.views import DataProductUploadView, DataProductDeleteView
 from tom_dataproducts.models import DataProduct
 from tom_dataproducts.exceptions import InvalidFileFormatException
 from custom_code.processors.data_processor import run_custom_data_processor
-from custom_code.hooks import run_fleet
-import threading
+from custom_code.jobs import enqueue_job
+from custom_code.cache import get_or_set_target_plot, get_or_set_airmass_plot, get_or_set_airmass_plots, invalidate_target_plots
 from guardian.shortcuts import assign_perm
 
 # Create your views here.
@@ -87,6 +89,9 @@ class TargetListView(PermissionListMixin, FilterView):
     permission_required = 'tom_targets.view_target'
     ordering = ['-id']
 
+    def get_queryset(self, *args, **kwargs):
+        return super().get_queryset(*args, **kwargs).select_related('photometrysummary')
+
     def get_context_data(self, *args, **kwargs):
         """
         Adds the number of targets visible, the available ``TargetList`` objects if the user is a    uthenticated, and
@@ -187,18 +192,38 @@ def targetlist_collapse_view(request):
     user_id = request.GET.get('user_id', None)
     user = User.objects.get(id=user_id)
 
-    lightcurve_plot = lightcurve_collapse(target, user)['plot']
-    spectra_plot = spectra_collapse(target)['plot']
-    airmass_plot = airmass_collapse(target)['figure']
+    lightcurve_plot = get_or_set_target_plot('lightcurve_collapse', target.id,
+                                             lambda: lightcurve_collapse(target, user)['plot'], user=user)
+    spectra_plot = get_or_set_target_plot('spectra_collapse', target.id,
+                                          lambda: spectra_collapse(target)['plot'])
 
     context = {
         'lightcurve_plot': lightcurve_plot,
-        'spectra_plot': spectra_plot,
-        'airmass_plot': airmass_plot
+        'spectra_plot': spectra_plot
     }
 
     return HttpResponse(json.dumps(context), content_type='application/json')
 
+
+# Most airmass plots returned by one targetlist_airmass request
+TARGETLIST_AIRMASS_MAX_TARGETS = 100
+
+
+def targetlist_airmass_view(request):
+
+    target_ids = request.GET.get('target_ids', '')
+    try:
+        target_ids = {int(target_id) for target_id in target_ids.split(',') if target_id}
+    except ValueError:
+        return HttpResponseBadRequest('target_ids must be a comma separated list of target ids')
+    if len(target_ids) > TARGETLIST_AIRMASS_MAX_TARGETS:
+        return HttpResponseBadRequest(f'At most {TARGETLIST_AIRMASS_MAX_TARGETS} target_ids can be requested at once')
+    targets = list(Target.objects.filter(id__in=target_ids))
+
+    airmass_plots = get_or_set_airmass_plots(targets, airmass_collapse_batch)
+
+    return HttpResponse(json.dumps(airmass_plots), content_type='application/json')
+
 class CustomTargetCreateView(TargetCreateView):
 
     def get_form_class(self):
@@ -312,16 +337,20 @@ class CustomDataProductUploadView(DataProductUploadView):
 class CustomDataProductDeleteView(DataProductDeleteView):
 
     def delete(self, request, *args, **kwargs):
-        ReducedDatum.objects.filter(data_product=self.get_object()).delete()
-        # Delete the ReducedDatumExtra row
-        reduced_datum_query = ReducedDatumExtra.objects.filter(data_type='photometry', key='upload_extras')
-        for row in reduced_datum_query:
-            value = row.value
-            if value.get('data_product_id', '') == int(self.get_object().id):
-                row.delete()
-                break
-        self.get_object().data.delete()
-        return super().delete(request, *args, **kwargs)
+        data_product = self.get_object()
+        with transaction.atomic():
+            ReducedDatum.objects.filter(data_product=data_product).delete()
+            # Delete the ReducedDatumExtra row of this photometry or spectroscopy upload,
+            # found through the indexed foreign key of its DataProductExtra
+            ReducedDatumExtra.objects.filter(dataproductextra__data_product=data_product).delete()
+            # Only remove the file once the database rows are gone for good
+            if data_product.data:
+                storage, name = data_product.data.storage, data_product.data.name
+                DataProduct.objects.filter(id=data_product.id).update(data=None)
+                transaction.on_commit(lambda: storage.delete(name))
+            transaction.on_commit(lambda: invalidate_target_plots(data_product.target_id))
+            response = super().delete(request, *args, **kwargs)
+        return response
 
 
 def save_dataproduct_groups_view(request):
@@ -366,6 +395,59 @@ class PaperCreateView(FormView):
 class RunFleetView(TargetDetailView):
     def get(self, request, *args, **kwargs):
         target = Target.objects.get(id=kwargs.get('pk', None))
-        fleet_thread = threading.Thread(target=run_fleet, args=[target])
-        fleet_thread.start()
+        enqueue_job('fleet', target)
         return HttpResponseRedirect('/targets/{}/'.format(target.id))
+
+
+class TargetPanelView(TargetDetailView):
+    """
+    Renders a single panel of the target detail page, which loads the
+    slower panels asynchronously from these views
+    """
+    def render_panel(self, context):
+        return render_to_string(self.template_name, context, request=self.request)
+
+    def get_panel(self, context):
+        return self.render_panel(context)
+
+    def render_to_response(self, context, **response_kwargs):
+        return HttpResponse(self.get_panel(context))
+
+
+class AirmassPanelView(TargetPanelView):
+    template_name = 'custom_code/panels/airmass.html'
+
+    def get_panel(self, context):
+        return get_or_set_airmass_plot('airmass_plot', self.object, lambda: self.render_panel(context))
+
+
+class LightcurvePanelView(TargetPanelView):
+    """
+    The interactive lightcurve is not cached, because the initial arguments
+    of the Dash app expire, but its photometry is
+    """
+    template_name = 'custom_code/panels/lightcurve.html'
+
+    def get_size(self, name, default, minimum=100, maximum=2000):
+        try:
+            size = int(self.request.GET[name])
+        except (KeyError, ValueError):
+            return default
+        return min(max(size, minimum), maximum)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['width'] = self.get_size('width', 600)
+        context['height'] = self.get_size('height', 360)
+        return context
+
+
+class SpectraPanelView(TargetPanelView):
+    template_name = 'custom_code/panels/spectra.html'
+
+    def get_panel(self, context):
+        return get_or_set_target_plot('spectra_plot', self.object.id, lambda: self.render_panel(context))
+
+
+class ObservationsPanelView(TargetPanelView):
+    template_name = 'custom_code/panels/observations.html'
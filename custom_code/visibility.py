@@ -0,0 +1,152 @@
+from astropy import units as u
+from astropy.time import Time
+from astropy.coordinates import AltAz, EarthLocation, get_sun
+from astroplan import time_grid_from_range
+from tom_observations import facility
+from collections import OrderedDict
+import numpy as np
+import threading
+
+# Sun altitudes keyed by (facility, site, grid start, resolution, grid length),
+# shared by every target rendered on the same time grid
+SUN_ALTITUDE_CACHE_SIZE = 256
+_sun_altitude_cache = OrderedDict()
+_sun_altitude_lock = threading.Lock()
+
+
+def get_observing_sites(facilities=None):
+    """
+    Collect the observing sites of every configured facility into a single
+    array of EarthLocations, so all sites can be transformed in one call.
+
+    :param facilities: names of the facilities to include, or None for all
+    :type facilities: list
+
+    :returns: list of (facility, site) labels and the matching EarthLocations
+    :rtype: list, astropy EarthLocation
+    """
+    labels = []
+    longitudes = []
+    latitudes = []
+    elevations = []
+    for observing_facility in facility.get_service_classes():
+        if facilities is not None and observing_facility not in facilities:
+            continue
+
+        observing_facility_class = facility.get_service_class(observing_facility)
+        sites = observing_facility_class().get_observing_sites()
+
+        for site, site_details in sites.items():
+            labels.append((observing_facility, site))
+            longitudes.append(site_details.get('longitude'))
+            latitudes.append(site_details.get('latitude'))
+            elevations.append(site_details.get('elevation'))
+
+    locations = EarthLocation.from_geodetic(
+        np.array(longitudes, dtype=float)*u.deg,
+        np.array(latitudes, dtype=float)*u.deg,
+        np.array(elevations, dtype=float)*u.m
+    )
+    return labels, locations
+
+
+def get_time_grid(start_time, end_time, interval):
+    """
+    Builds a time grid with the given resolution whose start is rounded down
+    to a multiple of the resolution, so that every request made within the same
+    bucket shares the same grid (and therefore the same solar ephemeris).
+
+    :param start_time: start of the window
+    :type start_time: datetime
+
+    :param end_time: end of the window
+    :type end_time: datetime
+
+    :param interval: time resolution of the grid, in minutes
+    :type interval: int
+
+    :rtype: astropy Time
+    """
+    start = Time(start_time)
+    length = Time(end_time) - start
+    bucket = interval * 60.
+    start = Time(np.floor(start.unix / bucket) * bucket, format='unix')
+    start.format = 'isot'
+    return time_grid_from_range(
+        time_range = [start, start + length],
+        time_resolution = interval*u.minute)
+
+
+def get_sun_altitude(sites, locations, time_range):
+    """
+    Returns the altitude of the sun at each site and time, computing it only
+    for the sites that are not already cached for this time grid.
+
+    :returns: sun altitudes with shape (number of sites, number of times)
+    :rtype: astropy Quantity
+    """
+    resolution = round((time_range[1] - time_range[0]).to_value(u.second)) if len(time_range) > 1 else 0
+    grid = (time_range[0].isot, resolution, len(time_range))
+    keys = [site + grid for site in sites]
+
+    with _sun_altitude_lock:
+        cached = [_sun_altitude_cache.get(key) for key in keys]
+        for key, sun_alt in zip(keys, cached):
+            if sun_alt is not None:
+                _sun_altitude_cache.move_to_end(key)
+
+    missing = [i for i, sun_alt in enumerate(cached) if sun_alt is None]
+    if missing:
+        frame = AltAz(obstime=time_range[np.newaxis, :], location=locations[missing][:, np.newaxis])
+        computed = get_sun(time_range).transform_to(frame).alt.to_value(u.deg)
+
+        with _sun_altitude_lock:
+            for i, sun_alt in zip(missing, computed):
+                cached[i] = sun_alt
+                _sun_altitude_cache[keys[i]] = sun_alt
+            while len(_sun_altitude_cache) > SUN_ALTITUDE_CACHE_SIZE:
+                _sun_altitude_cache.popitem(last=False)
+
+    return np.array(cached) * u.deg
+
+
+def get_visibility(coords, time_range, airmass_limit, facilities=None):
+    """
+    Computes the airmass of one or more sidereal targets at every observing
+    site and every time in ``time_range`` with a single frame transformation.
+
+    Points above the airmass limit, below the horizon, or outside of
+    astronomical twilight (sun above -18 degrees) are masked.
+
+    :param coords: target coordinates, either a scalar or a 1-D SkyCoord
+    :type coords: astropy SkyCoord
+
+    :param time_range: times at which to calculate the airmass
+    :type time_range: astropy Time
+
+    :param airmass_limit: maximum acceptable airmass
+    :type airmass_limit: float
+
+    :param facilities: names of the facilities to include, or None for all
+    :type facilities: list
+
+    :returns: list of (facility, site) labels and a masked array of airmasses
+        with shape coords.shape + (number of sites, number of times)
+    :rtype: list, numpy masked array
+    """
+    sites, locations = get_observing_sites(facilities)
+    if not sites:
+        return sites, np.ma.masked_all(coords.shape + (0, len(time_range)))
+
+    frame = AltAz(obstime=time_range[np.newaxis, :], location=locations[:, np.newaxis])
+
+    sun_alt = get_sun_altitude(sites, locations, time_range)
+    obj_airmass = coords[..., np.newaxis, np.newaxis].transform_to(frame).secz.value
+
+    bad_indices = (
+        (obj_airmass >= airmass_limit) |
+        (obj_airmass <= 1) |
+        (sun_alt > -18*u.deg)  #between astro twilights
+    )
+
+    return sites, np.ma.masked_array(obj_airmass, mask=bad_indices)
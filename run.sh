@@ -4,4 +4,5 @@ python manage.py migrate --noinput
 python manage.py runcadencestrategies
 printenv | cat - /snex2/crontab.txt | crontab
 service cron start
+python manage.py runworker > /proc/1/fd/1 2>&1 &
 gunicorn -b 0.0.0.0:8080 snex2.wsgi
@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/2.1/ref/settings/
 """
 
 import os
+import tempfile
 import django_heroku
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
@@ -120,6 +121,24 @@ else:
     }
 
 
+# Cache
+# https://docs.djangoproject.com/en/3.1/topics/cache/
+# Rendered plots are kept in a file-based cache so they are shared by every worker
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'plots': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.getenv('PLOT_CACHE_LOCATION', os.path.join(tempfile.gettempdir(), 'snex2_plots')),
+        'TIMEOUT': 7*24*60*60,
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000
+        }
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/2.1/ref/settings/#auth-password-validators
 
@@ -170,6 +189,13 @@ DATE_FORMAT = 'Y-m-d'
 STATIC_URL = '/static/'
 STATIC_ROOT = os.path.join(BASE_DIR, '_static')
 STATICFILES_DIRS = [os.path.join(BASE_DIR, 'static')]
+STATICFILES_FINDERS = [
+    'django.contrib.staticfiles.finders.FileSystemFinder',
+    'django.contrib.staticfiles.finders.AppDirectoriesFinder',
+    'custom_code.plotting.PlotlyJSFinder',
+]
+# plotly.js is served from a path with its version in it, so it can be cached forever
+WHITENOISE_IMMUTABLE_FILE_TEST = r'/plotly/[^/]+/plotly\.min\.js$'
 MEDIA_ROOT = os.getenv('MEDIA_ROOT', os.path.join(BASE_DIR, 'data'))
 MEDIA_URL = '/data/'
 
@@ -264,6 +290,22 @@ HOOKS = {
     'multiple_data_products_post_save': 'custom_code.hooks.multiple_data_products_post_save',
 }
 
+# FLEET runs in long-lived worker processes, and at most FLEET_PROCESSES (one per
+# core by default) run at once on this machine, counting the web server, runworker
+# and fleet_batch together through the lock files in FLEET_LOCK_LOCATION.
+# Runs that take longer than FLEET_TIMEOUT seconds are stopped.
+FLEET_PROCESSES = int(os.getenv('FLEET_PROCESSES', os.cpu_count() or 1))
+FLEET_TIMEOUT = int(os.getenv('FLEET_TIMEOUT', 30*60))
+FLEET_LOCK_LOCATION = os.getenv('FLEET_LOCK_LOCATION', os.path.join(MEDIA_ROOT, 'fleet_locks'))
+
+# Number of e91 frames measured by spikepipe at once
+SPIKEPIPE_PROCESSES = int(os.getenv('SPIKEPIPE_PROCESSES', min(4, os.cpu_count() or 1)))
+
+# PS1 catalogs matched to each target, shared by the spikepipe processes.
+# The least recently used files are deleted beyond PS1_CACHE_MAX_FILES.
+PS1_CACHE_LOCATION = os.getenv('PS1_CACHE_LOCATION', os.path.join(MEDIA_ROOT, 'ps1_cache'))
+PS1_CACHE_MAX_FILES = int(os.getenv('PS1_CACHE_MAX_FILES', 500))
+
 TOM_ALERT_CLASSES = [
     'custom_code.brokers.mars.CustomMARSBroker',
     'tom_alerts.brokers.lasair.LasairBroker',
@@ -303,6 +345,17 @@ DATA_PRODUCT_TYPES = {
     'image_file': ('image_file', 'Image File')
 }
 
+# Set to 'binary' to also store the wavelength and flux of new spectra as float32
+# arrays (custom_code.models.BinarySpectrum), which the SNEx2 plots read instead of
+# parsing the JSON value. The JSON value is kept, so TOM's views, SpectrumSerializer
+# and the REST API are not affected. Existing spectra are converted by 'manage.py convert_spectra'.
+SPECTRUM_STORAGE = os.getenv('SPECTRUM_STORAGE', 'json')
+
+# Lightcurve plots show at most this many points per filter, chosen to keep
+# their shape (the interactive plot shows every point when zoomed in). 0 shows all points.
+LIGHTCURVE_MAX_POINTS = int(os.getenv('LIGHTCURVE_MAX_POINTS', 2000))
+LIGHTCURVE_COLLAPSE_MAX_POINTS = int(os.getenv('LIGHTCURVE_COLLAPSE_MAX_POINTS', 300))
+
 DATA_PROCESSORS = {
     'photometry': 'custom_code.processors.photometry_processor.PhotometryProcessor',
     'spectroscopy': 'custom_code.processors.spectroscopy_processor.SpecProcessor',
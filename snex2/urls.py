@@ -18,7 +18,7 @@ from django.urls import path
 
 from django.urls import include
 
-from custom_code.views import TargetListView, CustomTargetCreateView, CustomDataProductUploadView, CustomDataProductDeleteView, target_redirect_view, add_tag_view, save_target_tag_view, targetlist_collapse_view, save_dataproduct_groups_view
+from custom_code.views import TargetListView, CustomTargetCreateView, CustomDataProductUploadView, CustomDataProductDeleteView, target_redirect_view, add_tag_view, save_target_tag_view, targetlist_collapse_view, targetlist_airmass_view, save_dataproduct_groups_view
 from custom_code.api_views import CustomDataProductViewSet
 from rest_framework.routers import DefaultRouter
 from custom_code.dash_apps import lightcurve
@@ -34,6 +34,7 @@ urlpatterns = [
     path('add_tag/', add_tag_view, name='add_tag'),
     path('save_target_tag/', save_target_tag_view, name='save_target_tag'),
     path('targetlist_collapse/', targetlist_collapse_view, name='targetlist_collapse'),
+    path('targetlist_airmass/', targetlist_airmass_view, name='targetlist_airmass'),
     path('create-target/', CustomTargetCreateView.as_view(), name='create-target'),
     path('custom-data-upload/', CustomDataProductUploadView.as_view(), name='custom-data-upload'),
     path('custom-upload-delete/<int:pk>/', CustomDataProductDeleteView.as_view(), name='custom-upload-delete'),